@@ -20,6 +20,8 @@ and any user provided settings file.
 
 # pylint: disable=invalid-name
 
+import contextlib
+import contextvars
 import copy
 import os
 import re
@@ -42,9 +44,56 @@ _PARSE_PATTERN = r'(#[A-Z]+)(\(([^(),]+)(,([0-9]+))?\))?'
 
 class Settings(object):
     """Holding class for settings.
+
+    Values loaded from configuration files form the base layer. Overlays
+    pushed by ``push_overlay`` or bound by ``overlay`` are stacked on top of
+    it, separately for every thread and asyncio task, so each scenario or
+    worker sees its own view without copying the base. Writes done while an
+    overlay is active go to the topmost overlay only. Once ``load_from_dir``
+    is done, the base is read only and writes require an active overlay.
     """
+    # overlays are kept in a slot, so they are not treated as settings
+    __slots__ = ('_overlays', '_frozen', '__dict__')
+
     def __init__(self):
-        pass
+        object.__setattr__(self, '_overlays', contextvars.ContextVar(
+            'settings_overlays_%x' % id(self), default=()))
+        object.__setattr__(self, '_frozen', False)
+
+    def _lookup(self, attr):
+        """Return raw value of ``attr`` from the topmost layer defining it
+        """
+        for layer in reversed(self._overlays.get()):
+            if attr in layer:
+                return layer[attr]
+        if attr in self.__dict__:
+            return self.__dict__[attr]
+        raise AttributeError("%r object has no attribute %r" %
+                             (self.__class__, attr))
+
+    def _keys(self):
+        """Return names of all settings visible in the current context
+        """
+        keys = set(self.__dict__)
+        for layer in self._overlays.get():
+            keys.update(layer)
+        return keys
+
+    def _store(self, name, value):
+        """Store value into the topmost overlay or into the base
+        """
+        layers = self._overlays.get()
+        if layers:
+            # copy on write, contexts copied from this one (worker threads)
+            # share the layer objects and must not see the change
+            top = dict(layers[-1])
+            top[name] = value
+            self._overlays.set(layers[:-1] + (top,))
+        elif self._frozen:
+            raise RuntimeError('Settings are read only, use an overlay to '
+                               'change {}'.format(name))
+        else:
+            super(Settings, self).__setattr__(name, value)
 
     def _eval_param(self, param):
         # pylint: disable=invalid-name
@@ -83,21 +132,19 @@ class Settings(object):
     def getValue(self, attr):
         """Return a settings item value
         """
-        if attr in self.__dict__:
-            if attr == 'TEST_PARAMS':
-                return getattr(self, attr)
-            else:
-                master_value = getattr(self, attr)
-                return self._eval_param(master_value)
-        else:
-            raise AttributeError("%r object has no attribute %r" %
-                                 (self.__class__, attr))
+        master_value = self._lookup(attr)
+        if attr == 'TEST_PARAMS':
+            return master_value
+        return self._eval_param(master_value)
 
     def hasValue(self, attr):
         """Return a settings item value
         """
         if attr in self.__dict__:
             return True
+        for layer in self._overlays.get():
+            if attr in layer:
+                return True
         return False
 
     def __setattr__(self, name, value):
@@ -108,13 +155,20 @@ class Settings(object):
             return
 
         # we can assume all uppercase keys are valid settings
-        super(Settings, self).__setattr__(name, value)
+        self._store(name, value)
+
+    def __getattribute__(self, name):
+        """Resolve settings through the overlays active in the current context
+        """
+        if name.isupper():
+            return object.__getattribute__(self, '_lookup')(name)
+        return object.__getattribute__(self, name)
 
     def setValue(self, name, value):
         """Set a value
         """
         if name is not None and value is not None:
-            super(Settings, self).__setattr__(name, value)
+            self._store(name, value)
 
     def load_from_file(self, path):
         """Update ``settings`` with values found in module at ``path``.
@@ -138,8 +192,11 @@ class Settings(object):
         :param dir_path: The full path to the dir from which to load the .conf
             files.
 
+        The base is read only once all files are loaded.
+
         :returns: None
         """
+        object.__setattr__(self, '_frozen', False)
         regex = re.compile("^(?P<digit_part>[0-9]+)(?P<alfa_part>[a-z]?)_.*.conf$")
 
         def get_prefix(filename):
@@ -165,6 +222,7 @@ class Settings(object):
         # load settings from each file in turn
         for filepath in file_paths:
             self.load_from_file(filepath)
+        object.__setattr__(self, '_frozen', True)
 
     def load_from_dict(self, conf):
         """
@@ -176,8 +234,11 @@ class Settings(object):
             if conf[key] is not None:
                 if isinstance(conf[key], dict):
                     # recursively update dict items, e.g. TEST_PARAMS
-                    setattr(self, key.upper(),
-                            merge_spec(getattr(self, key.upper()), conf[key]))
+                    orig = self._lookup(key.upper())
+                    if self._overlays.get():
+                        # copy on write, lower layers must stay untouched
+                        orig = copy.deepcopy(orig)
+                    setattr(self, key.upper(), merge_spec(orig, conf[key]))
                 else:
                     setattr(self, key.upper(), conf[key])
 
@@ -186,12 +247,63 @@ class Settings(object):
         Restore ``settings`` with values found in ``conf``.
 
         Method will drop all configuration options and restore their
-        values from conf dictionary
+        values from conf dictionary. Overlays active in the current context
+        are dropped as well. The read only state of the base is kept.
         """
+        self._overlays.set(())
         self.__dict__.clear()
         tmp_conf = copy.deepcopy(conf)
-        for key in tmp_conf:
-            self.setValue(key, tmp_conf[key])
+        frozen = self._frozen
+        object.__setattr__(self, '_frozen', False)
+        try:
+            for key in tmp_conf:
+                self.setValue(key, tmp_conf[key])
+        finally:
+            object.__setattr__(self, '_frozen', frozen)
+
+    def push_overlay(self, conf=None):
+        """
+        Push a new overlay with values from ``conf`` on top of ``settings``.
+
+        The overlay is visible only in the current thread or asyncio task
+        and in contexts copied from it. Like ``load_from_dict``, keys are
+        case insensitive and dict values are merged with the lower layers.
+
+        :returns: Depth of the overlay stack after the push.
+        """
+        layers = self._overlays.get() + ({},)
+        self._overlays.set(layers)
+        if conf:
+            self.load_from_dict(conf)
+        return len(layers)
+
+    def pop_overlay(self):
+        """
+        Drop the topmost overlay and return its values.
+        """
+        layers = self._overlays.get()
+        if not layers:
+            raise IndexError('No settings overlay to pop')
+        self._overlays.set(layers[:-1])
+        return layers[-1]
+
+    @contextlib.contextmanager
+    def overlay(self, conf=None):
+        """
+        Bind an overlay with values from ``conf`` for the ``with`` block.
+
+        Example:
+
+            >>> with settings.overlay({'SCENARIO_COMPUTE_NODES': 2}):
+            ...     settings.getValue('SCENARIO_COMPUTE_NODES')
+            2
+        """
+        depth = self.push_overlay(conf)
+        try:
+            yield self
+        finally:
+            # drop also overlays left behind inside of the block
+            self._overlays.set(self._overlays.get()[:depth - 1])
 
     def load_from_env(self):
         """
@@ -209,7 +321,7 @@ class Settings(object):
             A human-readable string.
         """
         tmp_dict = {}
-        for key in self.__dict__:
+        for key in self._keys():
             tmp_dict[key] = self.getValue(key)
 
         return pprint.pformat(tmp_dict)
@@ -228,12 +340,67 @@ class Settings(object):
     def validate_setValue(self, _dummy_result, name, value):
         """Verifies, that value was correctly set
         """
-        assert value == self.__dict__[name]
+        assert value == self._lookup(name)
         return True
 
 settings = Settings()
 
 
+def expand_macros(value, count):
+    """Expand configuration macros of ``value`` for ``count`` indices.
+
+    Every #VMINDEX is replaced by the index, #MAC(addr,step) and
+    #IP(addr,step) by the address incremented by ``step`` (1 by default)
+    for every index, #EVAL(expr) by the result of the expression. Values
+    other than strings are expanded in their string form and converted
+    back.
+
+    :returns: List of ``count`` expanded values, the value itself for
+        every index if it has no macros.
+    """
+    master_value = str(value)
+    if master_value.find('#') < 0:
+        return [value] * count
+
+    # addresses are parsed once, indices only shift them
+    addresses = {}
+
+    def address(macro, param):
+        if (macro, param) not in addresses:
+            if macro == '#MAC':
+                addresses[(macro, param)] = netaddr.EUI(param).value
+            else:
+                addresses[(macro, param)] = netaddr.IPAddress(param).value
+        return addresses[(macro, param)]
+
+    result = []
+    for vmindex in range(count):
+        expanded = master_value.replace('#VMINDEX', str(vmindex))
+        for macro, args, param, _, step in re.findall(_PARSE_PATTERN,
+                                                      expanded):
+            multi = int(step) if step and int(step) else 1
+            if macro == '#EVAL':
+                # pylint: disable=eval-used
+                tmp_result = str(eval(param))
+            elif macro == '#MAC':
+                mac = netaddr.EUI(address(macro, param) + vmindex * multi)
+                mac.dialect = netaddr.mac_unix_expanded
+                tmp_result = str(mac)
+            elif macro == '#IP':
+                tmp_result = str(netaddr.IPAddress(
+                    address(macro, param) + vmindex * multi))
+            else:
+                raise RuntimeError('Unknown configuration macro {} in {}'
+                                   .format(macro, master_value))
+            expanded = expanded.replace('{}{}'.format(macro, args),
+                                        tmp_result, 1)
+        # retype value to original type if needed
+        if not isinstance(value, str):
+            expanded = ast.literal_eval(expanded)
+        result.append(expanded)
+    return result
+
+
 def merge_spec(orig, new):
     """Merges ``new`` dict with ``orig`` dict, and returns orig.
 
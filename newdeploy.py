@@ -1,61 +1,165 @@
 import collections
+import concurrent.futures
+import contextvars
 import functools
+import hashlib
+import itertools
 import random
+import re
 import sys
 import os
+import threading
 import copy
 import json
 import jinja2
-import shutil
 import datetime
 import time
 import logging
 
+from conf import expand_macros
 from conf import merge_spec
 from conf import settings as S
 
+from utilities import hotcheck
+from utilities import lease
+from utilities import placement
+from utilities import readiness
+from utilities import results as result_store
+from utilities import runner
 from utilities import utils
+from utilities import vsperf
+from osclients import cassette
+from osclients import glance
 from osclients import heat
 from osclients import neutron
 from osclients import nova
 from osclients import openstack
+from osclients import ratelimit
+from osclients import resolver
 
 LOG = logging.getLogger(__name__)
 _CURR_DIR = os.path.dirname(os.path.realpath(__file__))
 
+# compute nodes discovered per client and flavor, reused for
+# INVENTORY_CACHE_TTL seconds
+_INVENTORY_CACHE = {}
+_INVENTORY_LOCK = threading.Lock()
+
+# accommodation changes applied to deployed stack by updating it
+_SCALABLE_ACCOMMODATION = ('compute_nodes', 'density')
+
 class DeploymentException(Exception):
     """ Exception Handling """
     pass
 
 
-def prepare_for_cross_az(compute_nodes, zones):
+class HostLeaseConflict(DeploymentException):
+    """ Planned hosts are leased by another deployment """
+    pass
+
+
+def _interleave_racks(nodes):
+    """
+    Order nodes so that consecutive nodes are in different racks
+    """
+    racks = collections.OrderedDict()
+    for node in nodes:
+        racks.setdefault(node.get('rack'), collections.deque()).append(node)
+
+    res = []
+    while racks:
+        for rack in list(racks):
+            res.append(racks[rack].popleft())
+            if not racks[rack]:
+                del racks[rack]
+    return res
+
+
+def prepare_for_cross_az(compute_nodes, zones, zone_pairs=None,
+                         rack_aware=False):
     """
     Deployment across Availability Zones
+
+    Returns nodes ordered as master, slave, master, slave, ... where
+    master and slave of every pair are in different zones. Zone pairs
+    (all combinations of zones unless ``zone_pairs`` is given) take turns
+    in round robin, and the roles alternate within every zone pair, so
+    inter-zone coverage and master/slave roles stay balanced. With
+    ``rack_aware`` set hosts of a zone are picked from different racks
+    in turn. Runs in linear time with the number of nodes.
     """
-    if len(zones) != 2:
-        LOG.warn('cross_az is specified, but len(zones) is not 2')
+    # zones may be given as zone:host too, keep order of the plain ones
+    buckets = collections.OrderedDict((zone, []) for zone in zones)
+    for node in compute_nodes:
+        buckets.setdefault(node['zone'], []).append(node)
+    buckets = collections.OrderedDict(
+        (zone, collections.deque(_interleave_racks(nodes) if rack_aware
+                                 else nodes))
+        for zone, nodes in buckets.items() if nodes)
+
+    if len(buckets) < 2:
+        LOG.warn('cross_az is specified, but nodes of less than 2 zones '
+                 'are available')
         return compute_nodes
 
-    masters = []
-    slaves = []
-    for node in compute_nodes:
-        if node['zone'] == zones[0]:
-            masters.append(node)
-        else:
-            slaves.append(node)
+    if zone_pairs:
+        pairs = [tuple(pair) for pair in zone_pairs
+                 if pair[0] in buckets and pair[1] in buckets and
+                 pair[0] != pair[1]]
+    else:
+        pairs = list(itertools.combinations(buckets, 2))
 
     res = []
-    for i in range(min(len(masters), len(slaves))):
-        res.append(masters[i])
-        res.append(slaves[i])
+    turns = collections.Counter()
+    while pairs:
+        active = []
+        for pair in pairs:
+            first, second = buckets[pair[0]], buckets[pair[1]]
+            if not first or not second:
+                continue  # the pair is exhausted for good
+            if turns[pair] % 2:
+                first, second = second, first
+            turns[pair] += 1
+            res.append(first.popleft())
+            res.append(second.popleft())
+            active.append(pair)
+        pairs = active
 
     return res
 
 
-def generate_agents(compute_nodes, accommodation, unique):
+def choose_hosts(compute_nodes, count, preferred=None, seed=None):
+    """
+    Choose compute nodes, preferred hosts first
+
+    The other hosts are chosen randomly, with seed given the choice is
+    the same for the same set of hosts.
+    """
+    rank = dict((host, i) for i, host in enumerate(preferred or []))
+    warm = sorted((c for c in compute_nodes if c['host'] in rank),
+                  key=lambda c: rank[c['host']])
+    cold = [c for c in compute_nodes if c['host'] not in rank]
+    if seed is None:
+        random.shuffle(cold)
+    else:
+        cold.sort(key=lambda c: (c['zone'] or '', c['host'] or ''))
+        random.Random(seed).shuffle(cold)
+    return (warm + cold)[:count]
+
+
+def generate_agents(compute_nodes, accommodation, unique, leases=None,
+                    preferred=None, seed=None, fixed_ip=None, fixed_mac=None):
     """
     Generate TestVNF Instances
+
+    With leases given, hosts leased by other deployments are skipped and
+    the chosen hosts are leased. Preferred hosts (e.g. with the image in
+    cache) are chosen first, seed makes the choice of others repeatable.
+    Fixed IP and MAC macros pre-assign data port addresses.
     """
+    if leases:
+        compute_nodes = [c for c in compute_nodes
+                         if not c['host'] or not leases.is_leased(c['host'])]
     print('Number of compute nodes')
     print(compute_nodes)
     density = accommodation.get('density') or 1
@@ -66,7 +170,10 @@ def generate_agents(compute_nodes, accommodation, unique):
             c for c in compute_nodes if c['zone'] in zones or
             ':'.join(filter(None, [c['zone'], c['host']])) in zones]
         if 'cross_az' in accommodation:
-            compute_nodes = prepare_for_cross_az(compute_nodes, zones)
+            compute_nodes = prepare_for_cross_az(
+                compute_nodes, zones,
+                zone_pairs=accommodation.get('zone_pairs'),
+                rack_aware=accommodation.get('rack_aware', False))
 
     best_effort = accommodation.get('best_effort', False)
     compute_nodes_requested = accommodation.get('compute_nodes')
@@ -84,9 +191,16 @@ def generate_agents(compute_nodes, accommodation, unique):
                     'Exception Not enough compute nodes %(cn)s for requested '
                     'instance accommodation %(acc)s' %
                     dict(cn=compute_nodes, acc=accommodation))
+        elif zones and 'cross_az' in accommodation:
+            # keep the order of cross zone pairs
+            compute_nodes = compute_nodes[:compute_nodes_requested]
         else:
-            compute_nodes = random.sample(compute_nodes,
-                                          compute_nodes_requested)
+            compute_nodes = choose_hosts(compute_nodes,
+                                         compute_nodes_requested,
+                                         preferred, seed)
+    elif preferred or seed is not None:
+        compute_nodes = choose_hosts(compute_nodes, len(compute_nodes),
+                                     preferred, seed)
 
     cn_count = len(compute_nodes)
     iterations = cn_count * density
@@ -146,6 +260,52 @@ def generate_agents(compute_nodes, accommodation, unique):
             az += ':' + agent['node']
         agent['availability_zone'] = az
 
+    if fixed_ip or fixed_mac:
+        assign_addresses(agents, fixed_ip, fixed_mac)
+
+    if leases:
+        conflicts = leases.acquire_all(
+            a['node'] for a in agents.values() if a['node'])
+        if conflicts:
+            raise HostLeaseConflict('Hosts %s are leased by another '
+                                    'deployment' % conflicts)
+
+    return agents
+
+
+def assign_addresses(agents, fixed_ip=None, fixed_mac=None):
+    """
+    Pre-compute data port addresses of the agents from macros
+
+    The macros (e.g. #IP(10.0.1.10), #MAC(fa:16:3e:00:01:00,2)) are
+    expanded for index of every agent in generated order, masters before
+    slaves, so agents keep their addresses when the stack is scaled.
+    """
+    ordered = sorted(agents.values(), key=_agent_order)
+    for key, macro in (('fixed_ip', fixed_ip), ('fixed_mac', fixed_mac)):
+        if not macro:
+            continue
+        for agent, value in zip(ordered, expand_macros(macro,
+                                                       len(ordered))):
+            agent[key] = value
+    return agents
+
+
+def drop_unused_addresses(agents, rendered_template):
+    """
+    Forget pre-assigned addresses the rendered template does not set
+
+    Outputs of such addresses are read from the stack, as the ports get
+    addresses assigned by Neutron.
+    """
+    for agent in agents.values():
+        for key in ('fixed_ip', 'fixed_mac'):
+            if agent.get(key) and not re.search(
+                    r'(?<![\w.:])%s(?![\w.:])' % re.escape(str(agent[key])),
+                    rendered_template):
+                LOG.debug('Template does not use %s %s of agent %s', key,
+                          agent[key], agent['id'])
+                del agent[key]
     return agents
 
 
@@ -161,45 +321,67 @@ def _get_stack_values(stack_outputs, vm_name, params):
     return result
 
 
-def filter_agents(agents, stack_outputs, override=None):
+def _deployed_agent(agent, stack_outputs, override=None):
     """
-    Filter Deployed Instances - If Required.
+    Update agent with its stack outputs, None if it is not deployed
     """
-    deployed_agents = {}
+    stack_values = _get_stack_values(stack_outputs, agent['id'], ['ip'])
+    new_stack_values = _get_stack_values(stack_outputs, agent['id'], ['pip'])
+    mac_values = _get_stack_values(stack_outputs, agent['id'], ['dmac'])
+    # PCI details of SR-IOV data ports, other templates have none
+    pci_values = _get_stack_values(stack_outputs, agent['id'], ['pci'])
 
-    # first pass, ignore non-deployed
-    for agent in agents.values():
-        stack_values = _get_stack_values(stack_outputs, agent['id'], ['ip'])
-        new_stack_values = _get_stack_values(stack_outputs, agent['id'], ['pip'])
-        mac_values = _get_stack_values(stack_outputs, agent['id'], ['dmac'])
+    if override:
+        stack_values.update(override(agent))
 
-        if override:
-            stack_values.update(override(agent))
+    # pre-assigned addresses make the outputs optional
+    if agent.get('fixed_ip') and not stack_values.get('ip'):
+        stack_values['ip'] = agent['fixed_ip']
+    if agent.get('fixed_mac') and not mac_values.get('dmac'):
+        mac_values['dmac'] = agent['fixed_mac']
 
-        if not stack_values.get('ip'):
-            LOG.info('Ignore non-deployed agent: %s', agent)
-            continue
+    if not stack_values.get('ip'):
+        LOG.info('Ignore non-deployed agent: %s', agent)
+        return None
 
-        if not new_stack_values.get('pip'):
-            LOG.info('Ignore non-deployed agent: %s', agent)
-            continue
+    if not new_stack_values.get('pip'):
+        LOG.info('Ignore non-deployed agent: %s', agent)
+        return None
 
-        if not mac_values.get('dmac'):
-            LOG.info('Ignore non-deployed agent: %s', agent)
-            continue
+    if not mac_values.get('dmac'):
+        LOG.info('Ignore non-deployed agent: %s', agent)
+        return None
 
-        agent.update(stack_values)
-        agent.update(new_stack_values)
+    agent.update(stack_values)
+    agent.update(new_stack_values)
+    agent.update(mac_values)
+    agent.update(pci_values)
 
-        # workaround of Nova bug 1422686
-        if agent.get('mode') == 'slave' and not agent.get('ip'):
-            LOG.info('IP address is missing in agent: %s', agent)
-            continue
+    # workaround of Nova bug 1422686
+    if agent.get('mode') == 'slave' and not agent.get('ip'):
+        LOG.info('IP address is missing in agent: %s', agent)
+        return None
 
-        deployed_agents[agent['id']] = agent
+    return agent
+
+
+def filter_agents(agents, stack_outputs, override=None, repair=False):
+    """
+    Filter Deployed Instances - If Required.
+
+    With repair set, masters and slaves which lost their partner are
+    paired with each other instead of being dropped.
+    """
+    deployed_agents = {}
+
+    # first pass, ignore non-deployed
+    for agent in agents.values():
+        if _deployed_agent(agent, stack_outputs, override):
+            deployed_agents[agent['id']] = agent
 
     # second pass, check pairs
     result = {}
+    orphans = collections.defaultdict(list)
     for agent in deployed_agents.values():
         print(agent.get('mode'))
         print(agent.get('ip'))
@@ -211,10 +393,45 @@ def filter_agents(agents, stack_outputs, override=None):
                 (agent.get('mode') == 'slave' and
                  agent.get('master_id') in deployed_agents)):
             result[agent['id']] = agent
+        elif repair:
+            orphans[agent.get('mode')].append(agent)
+
+    for master, slave in zip(orphans['master'], orphans['slave']):
+        LOG.info('Re-pair agent %s with agent %s', master['id'], slave['id'])
+        master['slave_id'] = slave['id']
+        slave['master_id'] = master['id']
+
+        result[master['id']] = master
+        result[slave['id']] = slave
 
     return result
 
 
+def split_pairs(agents):
+    """
+    Split agents map into maps of master/slave pairs and lone agents
+    """
+    return [dict((a['id'], a) for a in set_of_agents)
+            for set_of_agents in (
+                (master,) if master is slave else (master, slave)
+                for master, slave in vsperf.iter_pairs(agents))]
+
+
+def map_resources_to_agents(agents, resources):
+    """
+    Find agents owning Heat resources, resources are named after agents
+    """
+    owners = {}
+    for resource in resources:
+        parts = resource.split('_')
+        for i in range(len(parts), 0, -1):
+            candidate = '_'.join(parts[:i])
+            if candidate in agents:
+                owners[resource] = candidate
+                break
+    return owners
+
+
 def distribute_agents(agents, get_host_fn):
     """
     Distribute TestVNF Instances
@@ -249,6 +466,264 @@ def distribute_agents(agents, get_host_fn):
     return result
 
 
+_GROUP_ROLES = {'master': 'master', 'slave': 'slave', 'alone': 'agent'}
+_GROUP_OUTPUTS = ('instance_name', 'ip', 'pip', 'dmac', 'pci')
+# outputs of every agent used by filter_agents
+_AGENT_OUTPUTS = ('ip', 'pip', 'dmac')
+# data port options of the scenario, passed as template parameters
+_DATA_PORT_PARAMETERS = ('vnic_type', 'physical_network', 'network_type',
+                         'segmentation_id')
+
+
+def data_port_parameters(data_port):
+    """
+    Template parameters of data plane ports (SR-IOV, PCI passthrough)
+    """
+    params = {}
+    for key in _DATA_PORT_PARAMETERS:
+        if data_port.get(key) is not None:
+            params[key] = str(data_port[key])
+    if params.get('vnic_type', 'normal') != 'normal' and (
+            'physical_network' not in params):
+        raise DeploymentException('Data ports of vnic_type %s need '
+                                  'physical_network' % params['vnic_type'])
+    return params
+
+
+def group_parameters(agents):
+    """
+    Parameters of resource group based templates - count, availability
+    zone of every instance and indexes of dropped instances, per role
+
+    Dropped indexes go to the removal policy of the group, so Heat skips
+    them instead of creating unpinned instances in their place.
+    """
+    zones = dict((role, {}) for role in _GROUP_ROLES.values())
+    for agent in agents.values():
+        role = _GROUP_ROLES[agent['mode']]
+        index = int(agent['id'].rsplit('_', 1)[1])
+        zones[role][index] = agent['availability_zone']
+
+    params = {}
+    for role, by_index in zones.items():
+        size = max(by_index) + 1 if by_index else 0
+        params['%s_count' % role] = len(by_index)
+        params['%s_zones' % role] = [by_index.get(i, '')
+                                     for i in range(size)]
+        params['%s_removed' % role] = [str(i) for i in range(size)
+                                       if i not in by_index]
+    return params
+
+
+def map_group_members_to_agents(agents, members, unique):
+    """
+    Map failed members of resource groups to the agents they host, the
+    member names are the agent indexes within the role group
+    """
+    groups = dict(('%s_group' % role, role) for role in _GROUP_ROLES.values())
+    result = {}
+    for group, member in members:
+        if group not in groups:
+            continue
+        agent_id = '%s_%s_%s' % (unique, groups[group], member)
+        if agent_id in agents:
+            result['%s/%s' % (group, member)] = agent_id
+    return result
+
+
+def expand_group_outputs(stack_outputs, unique):
+    """
+    Split aggregated outputs of resource groups into per-agent outputs
+
+    Outputs are maps of member index to value, as indexes of dropped
+    members are not reused; plain lists are indexed by position.
+    """
+    result = dict(stack_outputs)
+    for role in _GROUP_ROLES.values():
+        for attr in _GROUP_OUTPUTS:
+            values = stack_outputs.get('%s_%s' % (role, attr)) or []
+            if isinstance(values, dict):
+                values = values.items()
+            else:
+                values = enumerate(values)
+            for index, value in values:
+                result['%s_%s_%s_%s' % (unique, role, index, attr)] = value
+    return result
+
+
+def _agent_outputs(agent):
+    """
+    Outputs of the agent not known before the stack exists
+    """
+    known = dict(ip=agent.get('fixed_ip'), dmac=agent.get('fixed_mac'))
+    return [attr for attr in _AGENT_OUTPUTS if not known.get(attr)]
+
+
+def required_outputs(agents, grouped=False):
+    """
+    Stack outputs filter_agents needs for the agents
+    """
+    if grouped:
+        roles = sorted(set(_GROUP_ROLES[a['mode']] for a in agents.values()))
+        return ['%s_%s' % (role, attr) for role in roles
+                for attr in _AGENT_OUTPUTS]
+    return ['%s_%s' % (agent_id, attr) for agent_id in sorted(agents)
+            for attr in _agent_outputs(agents[agent_id])]
+
+
+def agents_from_outputs(stack_outputs, unique):
+    """
+    Rebuild agents map from outputs of existing stack
+    """
+    pattern = re.compile(r'^(%s_(master|slave|agent)_(\d+))_ip$' %
+                         re.escape(unique))
+    agents = {}
+    for key in stack_outputs:
+        match = pattern.match(key)
+        if not match:
+            continue
+        agent_id, role, index = match.groups()
+        if role == 'master':
+            agents[agent_id] = dict(id=agent_id, mode='master',
+                                    slave_id='%s_slave_%s' % (unique, index))
+        elif role == 'slave':
+            agents[agent_id] = dict(id=agent_id, mode='slave',
+                                    master_id='%s_master_%s' % (unique, index))
+        else:
+            agents[agent_id] = dict(id=agent_id, mode='alone')
+        agents[agent_id].update(node=None, zone=None)
+    return agents
+
+
+# quota resources consumed by Heat resource types
+_QUOTA_RESOURCES = {
+    'OS::Nova::Server': 'instances',
+    'OS::Neutron::Port': 'port',
+    'OS::Neutron::Net': 'network',
+    'OS::Neutron::Subnet': 'subnet',
+    'OS::Neutron::Router': 'router',
+    'OS::Neutron::SecurityGroup': 'security_group',
+    'OS::Neutron::FloatingIP': 'floatingip',
+}
+
+
+def _agent_order(agent):
+    """
+    Sort key of generated agents - by index, masters before slaves
+    """
+    index = agent['id'].rsplit('_', 1)[-1]
+    return (int(index) if index.isdigit() else 0, agent['mode'])
+
+
+def _drop_agents(agents, agent_ids):
+    """
+    Drop agents together with their partners
+    """
+    drop = set(agent_ids)
+    for agent_id in agent_ids:
+        agent = agents[agent_id]
+        drop.add(agent.get('slave_id') or agent.get('master_id'))
+    return dict((k, v) for k, v in agents.items() if k not in drop)
+
+
+def template_demand(agents, rendered_template, files=None):
+    """
+    Quota resources consumed per agent and by shared resources
+    """
+    per_agent = collections.Counter()
+    shared = collections.Counter()
+    resources = utils.read_yaml(rendered_template).get('resources') or {}
+    owners = map_resources_to_agents(agents, resources)
+
+    for name, resource in resources.items():
+        quota = _QUOTA_RESOURCES.get(resource.get('type'))
+        if not quota:
+            continue
+        if name in owners:
+            per_agent[quota] += 1
+        else:
+            shared[quota] += 1
+    if agents:
+        for quota in per_agent:
+            per_agent[quota] = -(-per_agent[quota] // len(agents))
+
+    # every agent of a resource group based template is one nested stack
+    for nested in (files or {}).values():
+        for resource in (utils.read_yaml(nested).get('resources') or
+                         {}).values():
+            quota = _QUOTA_RESOURCES.get(resource.get('type'))
+            if quota:
+                per_agent[quota] += 1
+
+    return per_agent, shared
+
+
+def preflight_check(agents, per_agent, shared, available, host_free,
+                    best_effort=False):
+    """
+    Check planned agents against quotas and free capacity of hosts
+
+    :param per_agent: quota resources (instances, cores, ram, port, ...)
+        consumed by every agent
+    :param shared: quota resources consumed once per deployment
+    :param available: quota resources left in the project, None or
+        missing means unlimited
+    :param host_free: free cores and ram of every compute host
+    :returns: agents which fit, downsized when best_effort is allowed
+    """
+    problems = []
+
+    excess = []
+    by_host = collections.defaultdict(list)
+    for agent in sorted(agents.values(), key=_agent_order):
+        by_host[agent.get('node')].append(agent)
+    for host, host_agents in by_host.items():
+        free = host_free.get(host)
+        if not free:
+            continue
+        # flavor without known cores or ram does not limit the host
+        fits = min((free[r] // per_agent[r] for r in free
+                    if per_agent.get(r)), default=len(host_agents))
+        if len(host_agents) > fits:
+            problems.append('host %(host)s has capacity for %(fits)d of '
+                            '%(count)d agents' %
+                            dict(host=host, fits=max(fits, 0),
+                                 count=len(host_agents)))
+            excess.extend(a['id'] for a in host_agents[max(fits, 0):])
+
+    fits = len(agents)
+    for resource, amount in per_agent.items():
+        if amount and available.get(resource) is not None:
+            left = available[resource] - shared.get(resource, 0)
+            if left // amount < len(agents):
+                problems.append('quota of %(res)s allows %(fits)d of %(count)d '
+                                'agents' % dict(res=resource,
+                                                fits=max(left // amount, 0),
+                                                count=len(agents)))
+                fits = min(fits, max(left // amount, 0))
+    for resource, amount in shared.items():
+        if (available.get(resource) is not None and
+                available[resource] < amount + per_agent.get(resource, 0)):
+            problems.append('quota of %s is exhausted' % resource)
+            fits = 0
+
+    if not problems:
+        return agents
+    if not best_effort:
+        raise DeploymentException('Pre-flight check failed: %s' %
+                                  '; '.join(problems))
+
+    LOG.warn('Allowing best_effort accommodation, pre-flight check: %s',
+             '; '.join(problems))
+    agents = _drop_agents(agents, excess)
+    ordered = sorted(agents.values(), key=_agent_order)
+    agents = _drop_agents(agents, [a['id'] for a in ordered[fits:]])
+    if not agents:
+        raise DeploymentException('Pre-flight check failed, no agents fit: '
+                                  '%s' % '; '.join(problems))
+    return agents
+
+
 def normalize_accommodation(accommodation):
     """
     Planning the Accomodation of TestVNFs
@@ -271,23 +746,98 @@ def normalize_accommodation(accommodation):
     return result
 
 
+def _spec_value(value):
+    # Nova and aggregate metadata spell booleans in lower case
+    return str(value).lower() if isinstance(value, bool) else str(value)
+
+
+def flavor_spec(spec):
+    """
+    Name and properties of the flavor described in scenario
+
+    Aggregate metadata becomes aggregate_instance_extra_specs, so
+    compute nodes are filtered by it. Unnamed flavors are named after a
+    digest of the properties - the same spec reuses the same flavor.
+    """
+    extra_specs = dict((k, _spec_value(v)) for k, v in
+                       (spec.get('extra_specs') or {}).items())
+    for key, value in (spec.get('aggregate') or {}).items():
+        extra_specs['aggregate_instance_extra_specs:%s' % key] = (
+            _spec_value(value))
+    properties = dict(vcpus=spec['vcpus'], ram=spec['ram'],
+                      disk=spec.get('disk', 0), extra_specs=extra_specs)
+    name = spec.get('name')
+    if not name:
+        digest = hashlib.sha1(json.dumps(
+            properties, sort_keys=True).encode()).hexdigest()[:8]
+        name = 'tdep_%dc_%dm_%s' % (spec['vcpus'], spec['ram'], digest)
+    return name, properties
+
+
+def create_openstack_client(openstack_params, recorder=None):
+    """
+    Connect to OpenStack with session options from settings
+    """
+    rate_limiter = ratelimit.RateLimiter(
+        S.getValue('OS_RATE_LIMITS'), retries=S.getValue('OS_RETRIES'),
+        max_delay=S.getValue('OS_RETRY_MAX_DELAY'),
+        retry_status_codes=S.getValue('OS_RETRY_STATUS_CODES'))
+    return openstack.OpenStackClient(
+        openstack_params, recorder=recorder,
+        auth_cache_dir=S.getValue('OS_AUTH_CACHE_DIR'),
+        auth_cache_margin=S.getValue('OS_AUTH_CACHE_MARGIN'),
+        pool_size=S.getValue('OS_POOL_SIZE'), rate_limiter=rate_limiter)
+
+
+@functools.lru_cache(maxsize=32)
+def compile_template(heat_template):
+    """
+    Compile jinja template, compiled templates are reused
+    """
+    return jinja2.Template(heat_template)
+
+
+def _run_namespace():
+    """
+    Namespace of the run from RUN_NAMESPACE, a random one for 'auto'
+    """
+    namespace = (S.hasValue('RUN_NAMESPACE') and
+                 S.getValue('RUN_NAMESPACE'))
+    if not namespace:
+        return None
+    if namespace == 'auto':
+        namespace = utils.random_string()
+    return re.sub(r'[^\w.-]+', '_', str(namespace))
+
+
 class Deployment(object):
     """
     Main Deployment Class
     """
-    def __init__(self):
+    def __init__(self, openstack_client=None):
         """
         Initialize
         """
-        self.openstack_client = None
+        # a connected client may be shared by several deployments
+        self.openstack_client = openstack_client
         self.stack_id = None
         self.privileged_mode = True
+        self.recorder = None
+        self.poll_interval = 5
+        self.leases = None
 
         # The current run "owns" the support stacks, it is tracked
         # so it can be deleted later.
         self.support_stacks = []
         self.TrackStack = collections.namedtuple('TrackStack', 'name id')
 
+        # deployment state persisted after every phase, so the run
+        # can be resumed or reattached to later
+        self.state = {}
+
+        self.specification = None
+        self.base_dir = None
+
     def connect_to_openstack(self, openstack_params, flavor_name, image_name,
                              external_net, dns_nameservers):
         """
@@ -295,15 +845,53 @@ class Deployment(object):
         """
         LOG.debug('Connecting to OpenStack')
 
-        self.openstack_client = openstack.OpenStackClient(openstack_params)
+        # resolver cache would make recorded and replayed calls differ
+        resolver_cache = S.getValue('RESOLVER_CACHE_FILE')
+        replay_metadata = {}
+        if self.openstack_client is not None:
+            LOG.debug('Reusing connection to OpenStack')
+        elif S.hasValue('OS_CASSETTE_REPLAY'):
+            realtime = S.getValue('OS_CASSETTE_REALTIME')
+            self.openstack_client = cassette.ReplayClient(
+                S.getValue('OS_CASSETTE_REPLAY'), realtime=realtime)
+            replay_metadata = self.openstack_client.metadata
+            if not realtime:
+                self.poll_interval = 0
+            resolver_cache = None
+        else:
+            if S.hasValue('OS_CASSETTE_RECORD'):
+                self.recorder = cassette.Recorder()
+                resolver_cache = None
+            self.openstack_client = create_openstack_client(
+                openstack_params, recorder=self.recorder)
+        self.resolver = resolver.NameResolver(
+            self.openstack_client,
+            cache_file=resolver_cache,
+            cache_ttl=S.getValue('RESOLVER_CACHE_TTL'),
+            scope='%s|%s|%s' % (
+                openstack_params['auth'].get('auth_url'),
+                openstack_params.get('os_region_name'),
+                openstack_params['auth'].get('project_name')))
 
         self.flavor_name = flavor_name
         self.image_name = image_name
 
-        if S.hasValue('STACK_NAME'):
+        if replay_metadata.get('stack_name'):
+            # URLs of the recorded calls contain the stack name
+            self.stack_name = replay_metadata['stack_name']
+        elif S.hasValue('STACK_NAME') and S.getValue('STACK_NAME'):
             self.stack_name = S.getValue('STACK_NAME')
+            namespace = _run_namespace()
+            if namespace:
+                self.stack_name = '%s_%s' % (self.stack_name, namespace)
         else:
-            self.stack_name = 'testvnf_%s' % utils.random_string()
+            # state file given explicitly identifies the stack to reattach
+            # to, otherwise runs sharing the tenant get their own namespace
+            self.stack_name = (self._stored_stack_name() or
+                               'testvnf_%s' % (_run_namespace() or
+                                               utils.random_string()))
+        if self.recorder:
+            self.recorder.metadata['stack_name'] = self.stack_name
 
         self.dns_nameservers = dns_nameservers
         # intiailizing self.external_net last so that other attributes don't
@@ -312,14 +900,146 @@ class Deployment(object):
                              neutron.choose_external_net(
                                  self.openstack_client.neutron))
 
+    def get_run_name(self):
+        """
+        Name of the run, unique across clouds deployed concurrently
+        """
+        name = self.stack_name
+        if S.hasValue('OS_REGION_NAME') and S.getValue('OS_REGION_NAME'):
+            name = '%s_%s' % (S.getValue('OS_REGION_NAME'), name)
+        return name
+
+    def get_state_file(self):
+        """
+        Path to the file with persisted deployment state
+        """
+        if S.hasValue('STATE_FILE') and S.getValue('STATE_FILE'):
+            return S.getValue('STATE_FILE')
+        return os.path.join(S.getValue('STATE_DIR'),
+                            self.get_run_name() + '.json')
+
+    def save_state(self, phase, **kwargs):
+        """
+        Persist deployment state atomically
+        """
+        self.state.update(kwargs)
+        self.state.update(
+            phase=phase, stack_name=self.stack_name, stack_id=self.stack_id,
+            support_stacks=[s._asdict() for s in self.support_stacks],
+            updated=time.time())
+
+        state_file = self.get_state_file()
+        os.makedirs(os.path.dirname(state_file) or '.', exist_ok=True)
+        utils.write_file_atomic(json.dumps(self.state, indent=2,
+                                           sort_keys=True), state_file)
+        LOG.debug('Deployment state %s is saved to %s', phase, state_file)
+
+    @staticmethod
+    def _stored_stack_name():
+        """
+        Name of the stack recorded in explicitly given STATE_FILE, used
+        only when reattaching (a new stack of that name would conflict)
+        """
+        if not (S.getValue('REATTACH') and
+                S.hasValue('STATE_FILE') and S.getValue('STATE_FILE') and
+                os.path.exists(S.getValue('STATE_FILE'))):
+            return None
+        state = json.loads(utils.read_file(S.getValue('STATE_FILE')))
+        return state.get('stack_name')
+
+    def load_state(self):
+        """
+        Load persisted state of deployment with the current stack name
+        """
+        state_file = self.get_state_file()
+        if not os.path.exists(state_file):
+            return {}
+        state = json.loads(utils.read_file(state_file))
+        if state.get('stack_name') != self.stack_name:
+            LOG.warning('State file %s belongs to stack %s, ignoring it',
+                        state_file, state.get('stack_name'))
+            return {}
+        return state
+
+    def _reattach(self, specification):
+        """
+        Reattach to existing stack, restore agents saved in its state or
+        rebuild them from its outputs
+        """
+        heat_client = self.openstack_client.heat
+        state = self.load_state()
+        try:
+            stack_id = (state.get('stack_id') or
+                        heat.get_id_with_name(heat_client, self.stack_name))
+            status, reason = heat.get_stack_status(heat_client, stack_id)
+            if status == 'IN_PROGRESS':
+                # interrupted run, let the stack finish
+                heat.wait_stack_completion(heat_client, stack_id,
+                                           poll_interval=self.poll_interval)
+                status = 'COMPLETE'
+        except heat.exc.HTTPNotFound:
+            LOG.info('Stack %s does not exist, nothing to reattach to',
+                     self.stack_name)
+            return None
+
+        if status != 'COMPLETE':
+            raise DeploymentException(
+                'Can not reattach to stack %(stack)s in status %(status)s: '
+                '%(reason)s' % dict(stack=stack_id, status=status,
+                                    reason=reason))
+        LOG.info('Reattaching to stack %s', stack_id)
+
+        self.stack_id = stack_id
+        self.support_stacks = [self.TrackStack(**s)
+                               for s in state.get('support_stacks', [])]
+        self.state = state
+
+        if state.get('phase') == 'deployed' and state.get('outputs'):
+            outputs = state['outputs']
+        else:
+            outputs = expand_group_outputs(
+                heat.get_stack_outputs(heat_client, stack_id),
+                self.stack_name)
+        if state.get('phase') == 'deployed' and state.get('agents'):
+            # saved agents keep salvage re-pairing and distribution
+            agents = state['agents']
+        else:
+            agents = (state.get('plan') or
+                      agents_from_outputs(outputs, self.stack_name))
+            override = self._get_override(specification.get('override'))
+            agents = filter_agents(agents, outputs, override)
+        self.save_state('deployed', outputs=outputs, agents=agents)
+        return agents
+
     def _get_compute_nodes(self, accommodation):
         """
         Get available comput nodes
         """
+        cache_ttl = (S.hasValue('INVENTORY_CACHE_TTL') and
+                     S.getValue('INVENTORY_CACHE_TTL'))
+        cache_key = (self.openstack_client, self.flavor_name,
+                     bool(accommodation.get('rack_aware')))
+        if cache_ttl:
+            with _INVENTORY_LOCK:
+                cached = _INVENTORY_CACHE.get(cache_key)
+            if cached and time.time() - cached[0] < cache_ttl:
+                LOG.debug('Using cached compute nodes')
+                return copy.deepcopy(cached[1])
+
         try:
-            comps = nova.get_available_compute_nodes(self.openstack_client.nova,
-                                                     self.flavor_name)
-            print(comps)
+            comps = nova.get_available_compute_nodes(
+                self.openstack_client.nova, self.flavor_name,
+                flavor_id=self.resolver.flavor(self.flavor_name))
+            if accommodation.get('rack_aware'):
+                racks = nova.get_host_racks(self.openstack_client.nova,
+                                            S.getValue('RACK_METADATA_KEY'))
+                for comp in comps:
+                    comp['rack'] = racks.get(comp['host'])
+            LOG.debug('Available compute nodes: %s', comps)
+            if cache_ttl:
+                with _INVENTORY_LOCK:
+                    _INVENTORY_CACHE[cache_key] = (time.time(),
+                                                   copy.deepcopy(comps))
             return comps
         except nova.ForbiddenException:
             # user has no permissions to list compute nodes
@@ -336,17 +1056,92 @@ class Deployment(object):
             return [dict(host=None, zone=zones[n % len(zones)])
                     for n in range(count)]
 
-    #def _deploy_from_hot(self, specification, server_endpoint, base_dir=None):
-    def _deploy_from_hot(self, specification,  base_dir=None):
+    def _plan_stack(self, specification, base_dir=None):
         """
-        Perform Heat stack deployment
+        Plan agents and render the template and parameters of the stack
+
+        Hosts leased for a plan which fails are released, hosts of the
+        deployed stack stay leased.
+        """
+        live_agents = self.state.get('agents') if self.stack_id else {}
+        try:
+            return self._make_plan(specification, base_dir)
+        except Exception:
+            self._release_failed_plan(live_agents)
+            raise
+
+    def _make_plan(self, specification, base_dir=None):
+        """
+        Lease hosts for agents, render the template and its parameters
         """
         accommodation = normalize_accommodation(
             specification.get('accommodation') or
             specification.get('vm_accommodation'))
 
-        agents = generate_agents(self._get_compute_nodes(accommodation),
-                                 accommodation, self.stack_name)
+        # tuned guests - the flavor decides which compute nodes fit
+        if specification.get('flavor'):
+            self._ensure_flavor(specification['flavor'])
+        if specification.get('image_properties'):
+            self._ensure_image_properties(specification['image_properties'])
+
+        compute_nodes = self._get_compute_nodes(accommodation)
+        if (self.leases is None and S.hasValue('HOST_LEASE_DIR') and
+                S.getValue('HOST_LEASE_DIR')):
+            self.leases = lease.HostLeases(
+                S.getValue('HOST_LEASE_DIR'), self.stack_name,
+                ttl=S.getValue('HOST_LEASE_TTL'),
+                scope=(S.hasValue('OS_REGION_NAME') and
+                       S.getValue('OS_REGION_NAME') or ''))
+
+        # hosts with the image in cache are preferred, when scaling the
+        # hosts of the current agents are kept
+        history = None
+        preferred = []
+        if self.stack_id:
+            preferred = [a['node'] for a in sorted(
+                self.state.get('agents', {}).values(), key=_agent_order)]
+        if (S.hasValue('PLACEMENT_HISTORY_FILE') and
+                S.getValue('PLACEMENT_HISTORY_FILE')):
+            history = placement.PlacementHistory(
+                S.getValue('PLACEMENT_HISTORY_FILE'),
+                ttl=S.getValue('PLACEMENT_HISTORY_TTL'),
+                scope=(S.hasValue('OS_REGION_NAME') and
+                       S.getValue('OS_REGION_NAME') or ''))
+            preferred += history.warm_hosts(
+                self.resolver.image(self.image_name))
+        seed = (S.getValue('PLACEMENT_SEED')
+                if S.hasValue('PLACEMENT_SEED') else None)
+
+        # data port addresses known before the stack exists; templates
+        # based on resource groups have no per-agent ports to set them on
+        addresses = dict(
+            ip=S.getValue('AGENT_FIXED_IP')
+            if S.hasValue('AGENT_FIXED_IP') else None,
+            mac=S.getValue('AGENT_FIXED_MAC')
+            if S.hasValue('AGENT_FIXED_MAC') else None)
+        addresses.update(specification.get('addresses') or {})
+        if specification.get('nested_templates'):
+            addresses = {}
+
+        for attempt in range(S.getValue('HOST_LEASE_ATTEMPTS')):
+            try:
+                agents = generate_agents(compute_nodes, accommodation,
+                                         self.stack_name, self.leases,
+                                         preferred=preferred, seed=seed,
+                                         fixed_ip=addresses.get('ip'),
+                                         fixed_mac=addresses.get('mac'))
+                break
+            except HostLeaseConflict as e:
+                # another run leased some hosts in the meantime
+                LOG.info('%s, planning again', e)
+        else:
+            raise DeploymentException('Failed to lease compute hosts')
+        if self.leases:
+            # tests and sweeps may use the hosts for longer than ttl
+            self.leases.start_heartbeat()
+        self.save_state('planned', plan=agents,
+                        leased_hosts=sorted(self.leases.hosts
+                                            if self.leases else []))
 
         # render template by jinja
         vars_values = {
@@ -355,17 +1150,24 @@ class Deployment(object):
         }
         heat_template = utils.read_file(specification['template'],
                                         base_dir=base_dir)
-        compiled_template = jinja2.Template(heat_template)
+        compiled_template = compile_template(heat_template)
         rendered_template = compiled_template.render(vars_values)
-        LOG.info('Rendered template: %s', rendered_template)
+        LOG.info('Rendered template: %d bytes', len(rendered_template))
+        LOG.debug('Rendered template: %s', rendered_template)
+
+        # templates based on resource groups get the instances as
+        # parameters and their nested templates as files
+        files = dict((name, utils.read_file(name, base_dir=base_dir))
+                     for name in specification.get('nested_templates', []))
 
-        # create stack by Heat
+        # create stack by Heat, pass IDs so Heat does not resolve names
+        # again for every server in the stack
         try:
             merged_parameters = {
 #                'server_endpoint': server_endpoint,
-                'external_net': self.external_net,
-                'image': self.image_name,
-                'flavor': self.flavor_name,
+                'external_net': self.resolver.network(self.external_net),
+                'image': self.resolver.image(self.image_name),
+                'flavor': self.resolver.flavor(self.flavor_name),
                 'dns_nameservers': self.dns_nameservers,
             }
         except AttributeError as e:
@@ -373,29 +1175,385 @@ class Deployment(object):
                       'heat stack: %s', e)
             exit(1)
 
+        if S.getValue('PREFLIGHT_CHECK'):
+            planned = len(agents)
+            agents = self._preflight(agents, rendered_template, files,
+                                     accommodation.get('best_effort', False))
+            if len(agents) != planned:
+                vars_values['agents'] = agents
+                rendered_template = compiled_template.render(vars_values)
+                self._release_unused_hosts(agents)
+                self.save_state('planned', plan=agents)
+
+        # templates which ignore the addresses report their own ones
+        drop_unused_addresses(agents, rendered_template)
+
+        if files:
+            merged_parameters.update(group_parameters(agents))
+        merged_parameters.update(
+            data_port_parameters(specification.get('data_port') or {}))
         merged_parameters.update(specification.get('template_parameters', {}))
+        if S.getValue('VALIDATE_TEMPLATES'):
+            hotcheck.validate_template(
+                rendered_template, merged_parameters, files,
+                required_outputs(agents, grouped=bool(files)),
+                name=specification['template'])
+
+        # pre-warm is paid only by deployments which passed the checks
+        if S.getValue('IMAGE_PREWARM') and self.privileged_mode:
+            cold = sorted(set(a['availability_zone'] for a in agents.values()
+                              if a['node'] and a['node'] not in preferred))
+            if cold:
+                warmed = self._prewarm_image(cold)
+                if history:
+                    history.record(self.resolver.image(self.image_name),
+                                   [az.split(':', 1)[-1] for az in warmed])
+        return dict(agents=agents, accommodation=accommodation,
+                    compiled_template=compiled_template,
+                    vars_values=vars_values,
+                    rendered_template=rendered_template, files=files,
+                    parameters=merged_parameters, history=history)
+
+    #def _deploy_from_hot(self, specification, server_endpoint, base_dir=None):
+    def _deploy_from_hot(self, specification,  base_dir=None):
+        """
+        Perform Heat stack deployment
+        """
+        if S.getValue('REATTACH') and not self.stack_id:
+            agents = self._reattach(specification)
+            if agents is not None:
+                return agents
+
+        live_agents = self.state.get('agents') if self.stack_id else {}
+        plan = self._plan_stack(specification, base_dir)
+        accommodation = plan['accommodation']
+        history = plan['history']
+
+        salvage_mode = (S.hasValue('SALVAGE_MODE') and
+                        S.getValue('SALVAGE_MODE'))
         try:
-            self.stack_id = heat.create_stack(
-                self.openstack_client.heat, self.stack_name,
-                rendered_template, merged_parameters, None)
-        except heat.exc.StackFailure as err:
-            self.stack_id = err.args[0]
+            agents = self._apply_plan(plan, salvage_mode)
+        except Exception:
+            # leases of a failed stack must not block the hosts for ttl
+            self._release_failed_plan(live_agents)
             raise
+        self.save_state('created')
+        if history:
+            history.record(self.resolver.image(self.image_name),
+                           [a['node'] for a in agents.values()])
 
         # get info about deployed objects
-        outputs = heat.get_stack_outputs(self.openstack_client.heat,
-                                         self.stack_id)
+        outputs = expand_group_outputs(
+            heat.get_stack_outputs(self.openstack_client.heat,
+                                   self.stack_id),
+            self.stack_name)
         override = self._get_override(specification.get('override'))
 
-        agents = filter_agents(agents, outputs, override)
+        agents = filter_agents(agents, outputs, override,
+                               repair=(salvage_mode == 'drop'))
+        self._release_unused_hosts(agents)
 
         if (not self.privileged_mode) and accommodation.get('density', 1) == 1:
             get_host_fn = functools.partial(nova.get_server_host_id,
                                             self.openstack_client.nova)
             agents = distribute_agents(agents, get_host_fn)
 
+        self.save_state('deployed', outputs=outputs, agents=agents)
+        return agents
+
+    def _apply_plan(self, plan, salvage_mode=None):
+        """
+        Create the stack of the plan, or update the deployed one
+
+        :returns: agents of the stack, salvaged ones if it failed
+        """
+        agents = plan['agents']
+        try:
+            if self.stack_id:
+                # existing stack is scaled in place
+                heat.update_stack(
+                    self.openstack_client.heat, self.stack_id,
+                    plan['rendered_template'], plan['parameters'], None,
+                    poll_interval=self.poll_interval, files=plan['files'])
+            else:
+                self.stack_id = heat.create_stack(
+                    self.openstack_client.heat, self.stack_name,
+                    plan['rendered_template'], plan['parameters'], None,
+                    poll_interval=self.poll_interval, files=plan['files'])
+        except heat.exc.StackFailure as err:
+            self.stack_id = err.args[0]
+            self.save_state('failed')
+            if not salvage_mode:
+                raise
+            agents = self._salvage_stack(agents, plan['compiled_template'],
+                                         plan['vars_values'],
+                                         plan['parameters'], salvage_mode,
+                                         plan['files'])
+            self.save_state('salvaged', plan=agents)
+        return agents
+
+    def _salvage_stack(self, agents, compiled_template, vars_values,
+                       parameters, mode, files=None):
+        """
+        Recover failed stack - keep healthy agents, fix or drop failed ones
+
+        In 'retry' mode the stack is updated with unchanged template, so
+        Heat re-creates failed resources only. In 'drop' mode the failed
+        agents are removed from the template and survivors are re-paired.
+        """
+        heat_client = self.openstack_client.heat
+        agents = dict(agents)
+
+        for attempt in range(S.getValue('SALVAGE_RETRIES')):
+            failed = heat.get_failed_resources(heat_client, self.stack_id)
+            owners = map_resources_to_agents(agents, failed)
+            not_owned = set(failed) - set(owners)
+            if files:
+                # agents of resource groups are nested stacks, a group fails
+                # with its members and is fixed together with them
+                members = map_group_members_to_agents(
+                    agents, heat.get_failed_group_members(heat_client,
+                                                          self.stack_id),
+                    self.stack_name)
+                owners.update(members)
+                not_owned -= set(key.split('/')[0] for key in members)
+            if not_owned:
+                raise DeploymentException(
+                    'Stack %(stack)s can not be salvaged, shared resources '
+                    'failed: %(res)s' % dict(stack=self.stack_id,
+                                             res=sorted(not_owned)))
+
+            failed_agents = sorted(set(owners.values()))
+            LOG.warning('Salvaging stack %(stack)s (%(mode)s, attempt '
+                        '%(attempt)d), failed agents: %(agents)s',
+                        dict(stack=self.stack_id, mode=mode,
+                             attempt=attempt + 1, agents=failed_agents))
+            if mode == 'drop':
+                for agent_id in failed_agents:
+                    del agents[agent_id]
+                if not agents:
+                    break
+
+            vars_values = dict(vars_values, agents=agents)
+            if files:
+                parameters = dict(parameters, **group_parameters(agents))
+            try:
+                heat.update_stack(heat_client, self.stack_id,
+                                  compiled_template.render(vars_values),
+                                  parameters, None,
+                                  poll_interval=self.poll_interval,
+                                  files=files)
+                return agents
+            except heat.exc.StackFailure:
+                LOG.warning('Stack %s is still failed', self.stack_id)
+
+        raise DeploymentException('Failed to salvage stack %s' %
+                                  self.stack_id)
+
+    def _ensure_flavor(self, spec):
+        """
+        Create or reuse the flavor of the scenario, use it for the agents
+        """
+        name, properties = flavor_spec(spec)
+        flavor, created = nova.ensure_flavor(self.openstack_client.nova,
+                                             name, **properties)
+        if created:
+            # a flavor of the same name may have been deleted meanwhile
+            self.resolver.invalidate('flavor', name)
+        elif not nova.flavor_matches(flavor, **properties):
+            raise DeploymentException(
+                'Flavor %s exists with properties other than %s' %
+                (name, properties))
+        else:
+            LOG.info('Reusing flavor %s', name)
+        self.flavor_name = name
+
+    def _ensure_image_properties(self, properties):
+        """
+        Set Glance properties of the image (e.g. hw_vif_multiqueue_enabled)
+        """
+        image_id = self.resolver.image(self.image_name)
+        changed = glance.set_image_properties(self.openstack_client.glance,
+                                              image_id, properties)
+        if changed:
+            LOG.info('Properties %s of image %s are updated', changed,
+                     self.image_name)
+
+    def _prewarm_image(self, availability_zones):
+        """
+        Boot a throwaway instance on every host, IMAGE_PREWARM_WORKERS
+        at a time, so the image is in cache of the host before the stack
+        is created
+
+        :returns: availability zones (zone:host) warmed successfully
+        """
+        nova_client = self.openstack_client.nova
+        image_id = self.resolver.image(self.image_name)
+        flavor_id = self.resolver.flavor(self.flavor_name)
+        network_id = None
+        if S.hasValue('IMAGE_PREWARM_NETWORK'):
+            network_id = self.resolver.network(
+                S.getValue('IMAGE_PREWARM_NETWORK'))
+
+        timeout = S.getValue('IMAGE_PREWARM_TIMEOUT')
+
+        def prewarm(availability_zone):
+            server_id = nova.create_server(
+                nova_client, '%s_prewarm_%s' % (self.stack_name,
+                                                utils.random_string()),
+                image_id, flavor_id, availability_zone, network_id)
+            try:
+                nova.wait_server_active(
+                    nova_client, server_id,
+                    timeout=timeout, poll_period=self.poll_interval or 1)
+            finally:
+                nova.delete_server(nova_client, server_id)
+
+        LOG.info('Pre-warming image %s on %s', self.image_name,
+                 availability_zones)
+        warmed = []
+        # hundreds of concurrent boots would flood nova and glance
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(
+                len(availability_zones),
+                S.getValue('IMAGE_PREWARM_WORKERS'))) as executor:
+            futures = dict((executor.submit(prewarm, az), az)
+                           for az in availability_zones)
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    future.result()
+                    warmed.append(futures[future])
+                except Exception as e:
+                    LOG.warning('Failed to pre-warm image on %s: %s',
+                                futures[future], e)
+        return warmed
+
+    def _preflight(self, agents, rendered_template, files, best_effort):
+        """
+        Fail fast when planned agents do not fit quotas or hosts
+        """
+        nova_client = self.openstack_client.nova
+        per_agent, shared = template_demand(agents, rendered_template, files)
+
+        flavor = nova.get_flavor_by_id(nova_client,
+                                       self.resolver.flavor(self.flavor_name))
+        per_agent['cores'] = flavor.vcpus * per_agent['instances']
+        per_agent['ram'] = flavor.ram * per_agent['instances']
+
+        available = {}
+        try:
+            limits = nova.get_absolute_limits(nova_client)
+            for resource, limit, used in [
+                    ('instances', 'maxTotalInstances', 'totalInstancesUsed'),
+                    ('cores', 'maxTotalCores', 'totalCoresUsed'),
+                    ('ram', 'maxTotalRAMSize', 'totalRAMUsed')]:
+                if limits.get(limit, -1) >= 0:
+                    available[resource] = limits[limit] - limits.get(used, 0)
+
+            project_id = self.openstack_client.keystone_session.get_project_id()
+            quotas = neutron.get_quota_details(self.openstack_client.neutron,
+                                               project_id)
+            for resource, quota in quotas.items():
+                if quota['limit'] >= 0:
+                    available[resource] = (quota['limit'] - quota['used'] -
+                                           quota.get('reserved', 0))
+        except Exception as e:
+            LOG.warning('Failed to get project quotas, they are not '
+                        'checked: %s', e)
+
+        host_free = {}
+        if self.privileged_mode:
+            dedicated = (flavor.get_keys().get('hw:cpu_policy') ==
+                         'dedicated')
+            cpu_ratio = (1.0 if dedicated else
+                         S.getValue('PREFLIGHT_CPU_ALLOCATION_RATIO'))
+            ram_ratio = S.getValue('PREFLIGHT_RAM_ALLOCATION_RATIO')
+            try:
+                usage = nova.get_hypervisor_usage(nova_client)
+            except Exception as e:
+                LOG.warning('Failed to get hypervisor usage, capacity of '
+                            'hosts is not checked: %s', e)
+                usage = {}
+            for host, hv in usage.items():
+                if None in hv.values():
+                    continue
+                host_free[host] = dict(
+                    cores=int(hv['vcpus'] * cpu_ratio - hv['vcpus_used']),
+                    ram=int(hv['memory_mb'] * ram_ratio -
+                            hv['memory_mb_used']))
+
+        LOG.debug('Pre-flight check, per agent: %(agent)s, shared: '
+                  '%(shared)s, available: %(available)s',
+                  dict(agent=dict(per_agent), shared=dict(shared),
+                       available=available))
+        return preflight_check(agents, per_agent, shared, available,
+                               host_free, best_effort)
+
+    def scale(self, accommodation):
+        """
+        Change accommodation of the deployed stack
+
+        The changes (e.g. compute_nodes, density) override accommodation
+        of the deployed specification, the stack is updated in place.
+        """
+        if not self.stack_id:
+            raise DeploymentException('Nothing is deployed to scale')
+        specification = copy.deepcopy(self.specification)
+        changes = list(specification.pop('vm_accommodation', None) or
+                       specification.get('accommodation') or [])
+        changes.append(dict(accommodation))
+        specification['accommodation'] = changes
+        agents = self._deploy_from_hot(specification, base_dir=self.base_dir)
+        self.specification = specification
         return agents
 
+    def teardown(self):
+        """
+        Delete the stack and support stacks, release leased hosts
+        """
+        heat_client = self.openstack_client.heat
+        for stack_id in ([self.stack_id] if self.stack_id else []) + [
+                s.id for s in self.support_stacks]:
+            LOG.info('Deleting stack %s', stack_id)
+            heat.delete_stack(heat_client, stack_id,
+                              poll_interval=self.poll_interval)
+        self.stack_id = None
+        self.support_stacks = []
+        self.release_leases()
+        self.save_state('deleted', agents={}, outputs={})
+
+    def release_leases(self):
+        """
+        Release hosts leased by this deployment
+        """
+        if self.leases:
+            self.leases.release()
+            self.save_state(self.state.get('phase', 'released'),
+                            leased_hosts=[])
+
+    def _release_unused_hosts(self, agents):
+        """
+        Release leased hosts no agent is placed on (dropped or scaled down)
+        """
+        if not self.leases:
+            return
+        unused = self.leases.hosts - set(a.get('node')
+                                         for a in agents.values())
+        if unused:
+            LOG.info('Releasing unused hosts %s', sorted(unused))
+            self.leases.release(sorted(unused))
+            self.save_state(self.state.get('phase', 'released'),
+                            leased_hosts=sorted(self.leases.hosts))
+
+    def _release_failed_plan(self, live_agents):
+        """
+        Release hosts leased for a plan which is not deployed, keep only
+        the hosts of agents of the deployed stack
+        """
+        if live_agents:
+            self._release_unused_hosts(live_agents)
+        else:
+            self.release_leases()
+
     def _get_override(self, override_spec):
         """
         Collect the overrides
@@ -416,6 +1574,8 @@ class Deployment(object):
         Perform Deployment
         """
         agents = {}
+        self.specification = deployment
+        self.base_dir = base_dir
 
         if not deployment:
             # local mode, create fake agent
@@ -443,6 +1603,111 @@ class Deployment(object):
 
         return agents
 
+    def iter_deploy(self, deployment, base_dir=None):
+        """
+        Perform Deployment, yield pairs of agents as soon as they are ready
+
+        Only stacks with a server per agent are streamed - other kinds
+        of deployment and scaling are deployed as a whole first.
+        """
+        if (self.stack_id or not deployment.get('template') or
+                deployment.get('nested_templates') or
+                deployment.get('agents') or not self.openstack_client):
+            for pair in split_pairs(self.deploy(deployment, base_dir)):
+                yield pair
+            return
+
+        self.specification = deployment
+        self.base_dir = base_dir
+        if S.getValue('REATTACH'):
+            agents = self._reattach(deployment)
+            if agents is not None:
+                for pair in split_pairs(agents):
+                    yield pair
+                return
+
+        for pair in self._stream_from_hot(deployment, base_dir):
+            yield pair
+
+    def _stream_from_hot(self, specification, base_dir=None):
+        """
+        Create Heat stack, yield pairs whose servers are complete
+
+        Outputs of every completed server are read on their own, so the
+        first pairs are used while the rest of the stack is in progress.
+        """
+        plan = self._plan_stack(specification, base_dir)
+        agents = plan['agents']
+        heat_client = self.openstack_client.heat
+        try:
+            self.stack_id = heat.create_stack(
+                heat_client, self.stack_name, plan['rendered_template'],
+                plan['parameters'], None, files=plan['files'], wait=False)
+        except Exception:
+            self.release_leases()
+            raise
+        self.save_state('creating')
+
+        override = self._get_override(specification.get('override'))
+        check_hosts = ((not self.privileged_mode) and
+                       plan['accommodation'].get('density', 1) == 1)
+        hosts = set()
+        outputs = {}
+        ready = {}
+        try:
+            for name in heat.iter_complete_resources(
+                    heat_client, self.stack_id, 'OS::Nova::Server',
+                    poll_interval=self.poll_interval):
+                if name not in agents:
+                    continue
+                agent_outputs = heat.get_stack_output_values(
+                    heat_client, self.stack_id,
+                    ['%s_%s' % (name, attr) for attr in
+                     _agent_outputs(agents[name]) + ['pci']])
+                outputs.update(agent_outputs)
+                agent = _deployed_agent(agents[name], agent_outputs, override)
+                if agent is None:
+                    continue
+                if check_hosts:
+                    host_id = nova.get_server_host_id(
+                        self.openstack_client.nova, name)
+                    if host_id in hosts:
+                        LOG.info('Filter out agent %s, host %s is already '
+                                 'occupied', name, host_id)
+                        continue
+                    hosts.add(host_id)
+                    agent['node'] = host_id
+                ready[name] = agent
+
+                partner_id = agent.get('slave_id') or agent.get('master_id')
+                if agent['mode'] == 'alone':
+                    LOG.info('Agent %s is ready', name)
+                    yield {name: agent}
+                elif partner_id in ready:
+                    LOG.info('Pair of agents %s and %s is ready', name,
+                             partner_id)
+                    yield {name: agent, partner_id: ready[partner_id]}
+        except heat.exc.StackFailure:
+            self.save_state('failed')
+            # pairs already yielded are in use, the rest is not salvaged
+            if not (S.hasValue('SALVAGE_MODE') and
+                    S.getValue('SALVAGE_MODE')):
+                self.release_leases()
+                raise
+            LOG.warning('Stack %s failed, continuing with deployed pairs',
+                        self.stack_id)
+        else:
+            self.save_state('created')
+
+        deployed = dict((agent_id, agent) for agent_id, agent in ready.items()
+                        if agent['mode'] == 'alone' or
+                        (agent.get('slave_id') or
+                         agent.get('master_id')) in ready)
+        if plan['history']:
+            plan['history'].record(self.resolver.image(self.image_name),
+                                   [a['node'] for a in deployed.values()])
+        self.save_state('deployed', outputs=outputs, agents=deployed)
+
 def read_scenario(scenario_name):
     """
     Collect all Information about the scenario
@@ -475,42 +1740,51 @@ def _extend_agents(agents_map):
         extended_agents[agent['id']] = extended
     return extended_agents
 
-def play_scenario(scenario):
+def play_scenario(scenario, deployment=None, scale=None):
     """
     Deploy a scenario
+
+    With scale set, the stack of the given deployment is updated with
+    changed accommodation instead of deploying the scenario again (and
+    reused as it is when nothing changes).
     """
-    deployment = None
     output = dict(scenarios={}, agents={})
     output['scenarios'][scenario['title']] = scenario
 
     try:
-        deployment = Deployment()
-
-        openstack_params = utils.pack_openstack_params()
-        try:
-            deployment.connect_to_openstack(
-                openstack_params, S.getValue('FLAVOR_NAME'),
-                S.getValue('IMAGE_NAME'), S.getValue('EXTERNAL_NET'),
-                S.getValue('DNS_NAMESERVERS'))
-        except Exception as e:
-            LOG.warning('Failed to connect to OpenStack: %s. Please '
-                        'verify parameters: %s', e, openstack_params)
-
-        base_dir = os.path.dirname(scenario['file_name'])
-        scenario_deployment = scenario.get('deployment', {})
-        agents = deployment.deploy(scenario_deployment, base_dir=base_dir)
+        deployment = deployment or Deployment()
 
-        if not agents:
-            print("No VM Deployed - Play-Scenario")
-            raise Exception('No agents deployed.')
-
-        agents = _extend_agents(agents)
-        output['agents'] = agents
-        LOG.debug('Deployed agents: %s', agents)
-        print(agents)
+        if scale is not None and deployment.stack_id:
+            # agents of the stack are reused as they are if nothing changes
+            agents = (deployment.scale(scale) if scale else
+                      copy.deepcopy(deployment.state.get('agents') or {}))
+        else:
+            openstack_params = utils.pack_openstack_params()
+            try:
+                deployment.connect_to_openstack(
+                    openstack_params, S.getValue('FLAVOR_NAME'),
+                    S.getValue('IMAGE_NAME'), S.getValue('EXTERNAL_NET'),
+                    S.getValue('DNS_NAMESERVERS'))
+            except Exception as e:
+                LOG.warning('Failed to connect to OpenStack: %s. Please '
+                            'verify parameters: %s', e, openstack_params)
+
+            base_dir = os.path.dirname(scenario['file_name'])
+            scenario_deployment = scenario.get('deployment', {})
+            if S.getValue('STREAM_PAIRS'):
+                # pairs are tested while the rest is still booting
+                _play_pairs(deployment.iter_deploy(scenario_deployment,
+                                                   base_dir=base_dir),
+                            scenario, output)
+                output['state_file'] = deployment.get_state_file()
+                agents = None
+            else:
+                agents = deployment.deploy(scenario_deployment,
+                                           base_dir=base_dir)
 
-        if not agents:
-            raise Exception('No agents deployed.')
+        if agents is not None:
+            _play_agents(agents, scenario, output)
+            output['state_file'] = deployment.get_state_file()
 
     except BaseException as e:
         if isinstance(e, KeyboardInterrupt):
@@ -518,7 +1792,327 @@ def play_scenario(scenario):
             record = dict(id=utils.make_record_id(), status='interrupted')
         else:
             error_msg = 'Error while executing scenario: %s' % e
+            output['error'] = error_msg
             LOG.exception(e)
+
+    if deployment and deployment.openstack_client:
+        output['metrics'] = _export_metrics(deployment)
+    if deployment and deployment.recorder:
+        deployment.recorder.save(S.getValue('OS_CASSETTE_RECORD'))
+    return output
+
+def _iter_ready(agents):
+    """
+    Yield agents of every pair as soon as its guests are ready
+    """
+    for master, slave in readiness.iter_ready(
+            agents, port=S.getValue('READINESS_PORT'),
+            timeout=S.getValue('READINESS_TIMEOUT'),
+            deadline=S.getValue('READINESS_DEADLINE'),
+            interval=S.getValue('READINESS_INTERVAL'),
+            command=S.getValue('READINESS_COMMAND')):
+        yield dict(((master['id'], master), (slave['id'], slave)))
+
+
+def _play_agents(agents, scenario, output):
+    """
+    Generate VSPERF configuration for deployed agents and run it
+    """
+    if not agents:
+        print("No VM Deployed - Play-Scenario")
+        raise Exception('No agents deployed.')
+
+    if S.getValue('READINESS_CHECK'):
+        # guests may still be booting when Heat reports completion, every
+        # pair is played as soon as it is ready
+        _play_pairs([agents], scenario, output)
+        return
+
+    agents = _extend_agents(agents)
+    output['agents'] = agents
+    LOG.debug('Deployed agents: %s', agents)
+    print(agents)
+
+    if not agents:
+        raise Exception('No agents deployed.')
+
+    if S.getValue('VSPERF_TRAFFICGENS'):
+        output['vsperf_manifest'] = create_vsperf_conffile(agents)
+        if S.getValue('VSPERF_RUN'):
+            output['vsperf_results'] = run_vsperf(
+                output['vsperf_manifest'])
+            if (S.hasValue('RESULTS_STORE_DIR') and
+                    S.getValue('RESULTS_STORE_DIR')):
+                output['regressions'] = record_results(
+                    output['vsperf_results'], agents, scenario)
+
+
+def _play_pairs(pairs, scenario, output):
+    """
+    Generate VSPERF configuration and run it for every pair as it comes
+
+    Configuration of a pair is written and its runs are started while
+    the following pairs are still being deployed (or, with
+    READINESS_CHECK, probed), the manifest lists all pairs at the end.
+    Pairs are dicts of agents, any number of pairs each.
+    """
+    agents = output['agents']
+
+    def ready_pairs():
+        for pair in pairs:
+            for ready in (_iter_ready(pair) if S.getValue('READINESS_CHECK')
+                          else [pair]):
+                ready = _extend_agents(ready)
+                agents.update(ready)
+                for master, slave in vsperf.iter_pairs(ready):
+                    yield master, slave
+
+    if not S.getValue('VSPERF_TRAFFICGENS'):
+        for _pair in ready_pairs():
+            pass
+    else:
+        tgens = S.getValue('VSPERF_TRAFFICGENS')
+        dest_dir = _vsperf_dest_dir()
+        entries = []
+
+        def written_entries():
+            for entry in vsperf.iter_pair_confs(
+                    ready_pairs(), tgens, S.getValue('VSPERF_CONF_DIR'),
+                    dest_dir, values=S.getValue('VSPERF_VALUES')):
+                entries.append(entry)
+                yield entry
+
+        if S.getValue('VSPERF_RUN'):
+            output['vsperf_results'] = _run_vsperf(
+                runner.iter_entry_runs(written_entries(),
+                                       S.getValue('VSPERF_RUN_TRAFFICGENS')),
+                os.path.join(dest_dir, 'results.json'))
+        else:
+            for _entry in written_entries():
+                pass
+        if entries:
+            output['vsperf_manifest'] = vsperf.write_manifest(
+                entries, tgens, dest_dir, tags=_vsperf_tags())
+
+    LOG.debug('Deployed agents: %s', agents)
+    if not agents:
+        raise Exception('No agents deployed.')
+    if output.get('vsperf_results') and (
+            S.hasValue('RESULTS_STORE_DIR') and
+            S.getValue('RESULTS_STORE_DIR')):
+        output['regressions'] = record_results(
+            output['vsperf_results'], agents, scenario)
+
+
+def _export_metrics(deployment):
+    """
+    Export OpenStack API call statistics of the deployment
+    """
+    metrics = deployment.openstack_client.metrics
+    if not (S.hasValue('METRICS_DIR') and S.getValue('METRICS_DIR')):
+        return metrics.summary()
+
+    metrics_dir = S.getValue('METRICS_DIR')
+    os.makedirs(metrics_dir, exist_ok=True)
+    name = '%s_%s' % (deployment.get_run_name(), S.getValue('LOG_TIMESTAMP'))
+    try:
+        metrics.export(
+            prometheus_file=os.path.join(metrics_dir, name + '.prom'),
+            json_file=os.path.join(metrics_dir, name + '.json'))
+    except IOError as e:
+        LOG.warning('Failed to export API metrics: %s', e)
+    return metrics.summary()
+
+def expand_matrix(scenario):
+    """
+    Expand matrix of the scenario into sweep points
+
+    Every point has a template, accommodation, settings and VSPERF values
+    of its own. Points differing only in scalable accommodation or VSPERF
+    values share topology and are ordered next to each other, smaller
+    deployments first.
+    """
+    matrix = scenario.get('matrix') or {}
+    axes = []
+    if matrix.get('template'):
+        axes.append((('template', None), matrix['template']))
+    for section in ('accommodation', 'settings', 'vsperf'):
+        for key, values in sorted((matrix.get(section) or {}).items()):
+            axes.append(((section, key), values))
+
+    points = []
+    topologies = []
+    for index, combination in enumerate(
+            itertools.product(*[values for _axis, values in axes])):
+        point = dict(id='point%d' % index, values={},
+                     template=scenario['deployment'].get('template'),
+                     accommodation={}, settings={}, vsperf={})
+        for (section, key), value in zip([axis for axis, _v in axes],
+                                         combination):
+            point['values'][key or section] = value
+            if key is None:
+                point[section] = value
+            else:
+                point[section][key] = value
+
+        topology = json.dumps(dict(
+            template=point['template'], settings=point['settings'],
+            accommodation=dict(
+                (k, v) for k, v in point['accommodation'].items()
+                if k not in _SCALABLE_ACCOMMODATION)), sort_keys=True)
+        if topology not in topologies:
+            topologies.append(topology)
+        point['topology'] = topology
+        points.append(point)
+
+    def size(point):
+        return [point['accommodation'].get(k) or 0
+                for k in _SCALABLE_ACCOMMODATION]
+
+    return sorted(points, key=lambda p: [topologies.index(p['topology'])] +
+                  size(p))
+
+def play_sweep(scenario):
+    """
+    Play all points of the scenario matrix
+
+    Points with the same topology reuse one deployment which is scaled
+    between them, it is deleted before the next topology is deployed (or
+    after a point fails) and when the sweep ends. Outputs are keyed by
+    point id and tagged by values of the point. Results of all points are
+    stored under the run id of the sweep, tagged by point id.
+    """
+    output = dict(scenarios={}, agents={}, points={})
+    output['scenarios'][scenario['title']] = scenario
+
+    run_id = S.getValue('LOG_TIMESTAMP')
+    deployment = None
+    topology = None
+    accommodation = {}
+    try:
+        for point in expand_matrix(scenario):
+            LOG.info('Play sweep point %s: %s', point['id'], point['values'])
+            point_scenario = copy.deepcopy(scenario)
+            point_scenario['deployment']['template'] = point['template']
+            point_scenario['deployment']['accommodation'] = list(
+                point_scenario['deployment'].get('accommodation') or
+                point_scenario['deployment'].get('vm_accommodation') or
+                []) + [point['accommodation']]
+            point_scenario['title'] = '%s [%s]' % (scenario['title'],
+                                                    point['id'])
+
+            scale = None
+            if (deployment is not None and point['topology'] == topology and
+                    deployment.state.get('agents')):
+                scale = dict((k, v)
+                             for k, v in point['accommodation'].items()
+                             if accommodation.get(k) != v)
+            elif deployment is not None and deployment.stack_id:
+                deployment.teardown()
+            if scale is None:
+                deployment = Deployment()
+                topology = point['topology']
+            accommodation = point['accommodation']
+
+            with S.overlay(point['settings']):
+                S.setValue('SWEEP_POINT', dict(id=point['id'], run=run_id,
+                                               values=point['values']))
+                S.setValue('LOG_TIMESTAMP', '%s_%s' % (run_id, point['id']))
+                S.setValue('VSPERF_VALUES', dict(S.getValue('VSPERF_VALUES'),
+                                                 **point['vsperf']))
+                point_output = play_scenario(point_scenario, deployment,
+                                             scale=scale)
+
+            if point_output.get('error'):
+                LOG.warning('Sweep point %s failed: %s', point['id'],
+                            point_output['error'])
+                # the stack of a failed point is not reused
+                topology = None
+            for agent in point_output['agents'].values():
+                agent['sweep_point'] = point['id']
+            point_output['values'] = point['values']
+            output['points'][point['id']] = point_output
+    finally:
+        if deployment is not None and deployment.stack_id:
+            deployment.teardown()
+
+    return output
+
+def play_scenario_on_clouds(scenario, clouds):
+    """
+    Deploy a scenario to several clouds concurrently
+
+    Every cloud is a dict of settings (OS_AUTH_URL, OS_REGION_NAME, ...)
+    applied as an overlay in its own worker. Agents of all clouds are
+    merged, keyed by "<cloud name>/<agent id>" ("<cloud name>/<point
+    id>/<agent id>" for sweep points), with ids of the agents and their
+    partners rewritten to the same keys, and tagged by cloud name and
+    region. A cloud which fails is recorded as {'error': ...} in regions.
+    """
+    output = dict(scenarios={}, agents={}, regions={})
+    output['scenarios'][scenario['title']] = scenario
+
+    def play_on_cloud(name, cloud):
+        with S.overlay(cloud):
+            # keep generated files of the clouds apart
+            S.setValue('VSPERF_OUTPUT_DIR', os.path.join(
+                S.getValue('VSPERF_OUTPUT_DIR'), name))
+            if (S.hasValue('OS_CASSETTE_RECORD') and
+                    S.getValue('OS_CASSETTE_RECORD')):
+                root, ext = os.path.splitext(
+                    S.getValue('OS_CASSETTE_RECORD'))
+                S.setValue('OS_CASSETTE_RECORD',
+                           '%s_%s%s' % (root, name, ext))
+            if S.hasValue('STATE_FILE') and S.getValue('STATE_FILE'):
+                root, ext = os.path.splitext(S.getValue('STATE_FILE'))
+                S.setValue('STATE_FILE', '%s_%s%s' % (root, name, ext))
+            if scenario.get('matrix'):
+                return play_sweep(scenario)
+            return play_scenario(scenario)
+
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=len(clouds)) as executor:
+        futures = {}
+        for index, cloud in enumerate(clouds):
+            cloud = dict(cloud)
+            name = (cloud.pop('name', None) or cloud.get('OS_REGION_NAME') or
+                    'cloud%d' % index)
+            # every worker runs in a copy of the current settings context
+            future = executor.submit(contextvars.copy_context().run,
+                                     play_on_cloud, name, cloud)
+            region = (cloud.get('OS_REGION_NAME') or
+                      (S.hasValue('OS_REGION_NAME') and
+                       S.getValue('OS_REGION_NAME')))
+            futures[future] = (name, region)
+
+        for future in concurrent.futures.as_completed(futures):
+            name, region = futures[future]
+            try:
+                cloud_output = future.result()
+            except Exception as e:
+                # results of the other clouds are still merged
+                LOG.exception('Deployment to cloud %s failed: %s', name, e)
+                output['regions'][name] = {'error': str(e)}
+                continue
+            output['regions'][name] = cloud_output
+            # agents of a sweep are played per point
+            if 'points' in cloud_output:
+                groups = [('%s/%s' % (name, point_id),
+                           point.get('agents') or {})
+                          for point_id, point
+                          in cloud_output['points'].items()]
+            else:
+                groups = [(name, cloud_output.get('agents') or {})]
+            for prefix, agents in groups:
+                for agent_id, agent in agents.items():
+                    agent = dict(agent, cloud=name, region=region)
+                    for ref in ('id', 'slave_id', 'master_id'):
+                        if agent.get(ref):
+                            agent[ref] = '%s/%s' % (prefix, agent[ref])
+                    output['agents']['%s/%s' % (prefix, agent_id)] = agent
+            LOG.info('Deployment to cloud %s finished with %d agents',
+                     name, sum(len(agents) for _, agents in groups))
+
     return output
 
 def act():
@@ -529,42 +2123,119 @@ def act():
         LOG.info('Play scenario: %s', scenario_name)
         print('Play scenario: {}'.format(scenario_name))
         scenario = read_scenario(scenario_name)
-        play_output = play_scenario(scenario)
+        # scenario specific settings are visible only while it is played
+        with S.overlay(scenario.get('settings')):
+            if S.hasValue('OS_CLOUDS') and S.getValue('OS_CLOUDS'):
+                play_output = play_scenario_on_clouds(
+                    scenario, S.getValue('OS_CLOUDS'))
+            elif scenario.get('matrix'):
+                play_output = play_sweep(scenario)
+            else:
+                play_output = play_scenario(scenario)
         print(play_output)
         return play_output
 
-def create_vsperf_conffile(agents, tgen):
+def create_vsperf_conffile(agents, tgens=None, dest_dir=None):
     """
-    Create Configuration file for VSPERF.
+    Create Configuration files for VSPERF - one per deployed pair.
     """
-    date = datetime.datetime.fromtimestamp(time.time())
-    timestamp = date.strftime('%Y-%m-%d_%H-%M-%S')
     if not len(agents):
         print("No agents provided")
         return
-    filename = 'vsperf-'+ tgen + '.conf'
-    filepath = os.path.join('./testconfs', filename)
-    destfilename = 'vsperf-' + tgen + "-" + timestamp + ".conf"
-    destfilepath = os.path.join('./testconfs', destfilename)
-    shutil.copyfile(filepath, destfilepath)
-    print('Using File: ', destfilepath)
-    east_chassis_ip = agents[0]['public_ip']
-    east_data_ip = agents[0]['private_ip']
-    if len(agents) == 2:
-        west_chassis_ip = agents[1]['public_ip']
-        west_data_ip = agents[1]['private_ip']
-    else:
-        west_chassis_ip = east_chassis_ip
-        west_data_ip = east_chassis_ip
-    with open(destfilepath, "+a") as filep:
-        if tgen == "spirent":
-            filep.write('TRAFFICGEN_STC_EAST_CHASSIS_ADDR = "{0}" \n'.format(east_chassis_ip))
-            filep.write('TRAFFICGEN_STC_WEST_CHASSIS_ADDR = "{0}" \n'.format(west_chassis_ip))
-        if tgen == "ixnet":
-            filep.writelines("TRAFFICGEN_EAST_IXIA_HOST = " +
-                        east_chassis_ip + '\n')
-            filep.writelines("TRAFFICGEN_WEST_IXIA_HOST = " +
-                        west_chassis_ip + '\n')
+    if isinstance(tgens, str):
+        tgens = [tgens]
+    tgens = tgens or S.getValue('VSPERF_TRAFFICGENS')
+    if not dest_dir:
+        dest_dir = _vsperf_dest_dir()
+    manifest = vsperf.write_pair_confs(
+        vsperf.iter_pairs(agents), tgens, S.getValue('VSPERF_CONF_DIR'),
+        dest_dir, values=S.getValue('VSPERF_VALUES'), tags=_vsperf_tags())
+    LOG.info('Using manifest: %s', manifest)
+    return manifest
+
+def _vsperf_dest_dir():
+    return os.path.join(S.getValue('VSPERF_OUTPUT_DIR'),
+                        S.getValue('LOG_TIMESTAMP'))
+
+def _vsperf_tags():
+    tags = {}
+    if S.hasValue('SWEEP_POINT'):
+        tags['sweep_point'] = S.getValue('SWEEP_POINT')
+    return tags
+
+def run_vsperf(manifest):
+    """
+    Execute VSPERF for all pairs of the manifest in parallel
+
+    Results are stored next to the manifest as runs finish.
+    """
+    runs = runner.iter_manifest_runs(manifest,
+                                     S.getValue('VSPERF_RUN_TRAFFICGENS'))
+    return _run_vsperf(runs, os.path.join(os.path.dirname(manifest),
+                                          'results.json'))
+
+def _run_vsperf(runs, results_path):
+    """
+    Execute VSPERF runs, rewrite results file as runs finish
+    """
+    results = []
+    for result in runner.iter_results(
+            runs, S.getValue('VSPERF_COMMAND'),
+            max_workers=S.getValue('VSPERF_RUN_WORKERS'),
+            timeout=S.getValue('VSPERF_RUN_TIMEOUT')):
+        LOG.info('VSPERF run of pair %s with %s: %s', result['pair'],
+                 result['tgen'], result['status'])
+        results.append(result)
+        utils.write_file_atomic(json.dumps(results, indent=2,
+                                           sort_keys=True), results_path)
+    return results_path
+
+def record_results(results_path, agents, scenario):
+    """
+    Append per-pair results of the run to the results store, compare
+    them with the baseline run
+
+    :returns: list of regressions against RESULTS_BASELINE_RUN
+    """
+    with open(results_path) as fd:
+        runs = json.load(fd)
+    point = S.getValue('SWEEP_POINT') if S.hasValue('SWEEP_POINT') else {}
+    # points of a sweep share the run id, they are told apart by point id
+    run_id = point.get('run') or S.getValue('LOG_TIMESTAMP')
+
+    rows = []
+    for run in runs:
+        master = agents.get(run['master'], {})
+        slave = agents.get(run['slave'], {})
+        metadata = dict(
+            run=run_id, timestamp=time.time(), scenario=scenario['title'],
+            template=scenario.get('deployment', {}).get('template'),
+            sweep_point=point.get('id'), pair=run['pair'], tgen=run['tgen'],
+            status=run['status'], mode=master.get('mode'),
+            master_node=master.get('node'), master_zone=master.get('zone'),
+            slave_node=slave.get('node'), slave_zone=slave.get('zone'))
+        for row in run.get('rows') or [{}]:
+            rows.append(dict(row, **metadata))
+
+    store = result_store.ResultStore(S.getValue('RESULTS_STORE_DIR'))
+    store.append(rows)
+
+    regressions = []
+    if (S.hasValue('RESULTS_BASELINE_RUN') and
+            S.getValue('RESULTS_BASELINE_RUN')):
+        table = store.load()
+        if point.get('id'):
+            table = table.where(sweep_point=point['id'])
+        for metric, higher_is_better in sorted(
+                S.getValue('RESULTS_REGRESSION_METRICS').items()):
+            regressions.extend(result_store.find_regressions(
+                table, S.getValue('RESULTS_BASELINE_RUN'), run_id, metric,
+                threshold=S.getValue('RESULTS_REGRESSION_THRESHOLD'),
+                higher_is_better=higher_is_better))
+        for regression in regressions:
+            LOG.warning('Regression of %(metric)s for %(key)s: %(value)s, '
+                        'baseline %(baseline)s', regression)
+    return regressions
 
 def main():
     """Main function.
@@ -0,0 +1,374 @@
+"""
+Deployment service
+
+Keeps OpenStack sessions, compiled templates and compute node inventory
+warm between deployments requested over a local HTTP API (Unix socket
+readable by the owner only, TCP on request). Requests are processed
+concurrently, operations on the same deployment one after another.
+Requests and their scenario files may override only settings listed in
+SERVICE_SETTINGS.
+
+    POST   /deployments             {"scenario": file, "settings": {...}}
+    GET    /deployments
+    GET    /deployments/<id>
+    POST   /deployments/<id>/scale  {"compute_nodes": 4, "density": 2}
+    DELETE /deployments/<id>
+    GET    /metrics
+"""
+
+import argparse
+import concurrent.futures
+import contextvars
+import datetime
+import http.server
+import json
+import logging
+import os
+import re
+import socketserver
+import threading
+import time
+
+from conf import settings as S
+from utilities import utils
+import newdeploy
+
+LOG = logging.getLogger(__name__)
+_CURR_DIR = os.path.dirname(os.path.realpath(__file__))
+
+
+class ServiceException(Exception):
+    """
+    Request can not be processed, carries the HTTP status code
+    """
+    def __init__(self, code, message):
+        super(ServiceException, self).__init__(message)
+        self.code = code
+
+
+def check_settings(settings, origin=''):
+    """
+    Reject settings not listed in SERVICE_SETTINGS, so clients can not
+    change commands or credentials used by the service
+    """
+    allowed = set(S.getValue('SERVICE_SETTINGS'))
+    denied = sorted(str(key) for key in settings
+                    if str(key).upper() not in allowed)
+    if denied:
+        raise ServiceException(400, 'Settings %scan not be overridden: %s' %
+                               (origin, ', '.join(denied)))
+
+
+class Job(object):
+    """
+    Deployment managed by the service
+    """
+    def __init__(self, job_id, scenario, settings):
+        self.id = job_id
+        self.scenario = scenario
+        self.settings = settings or {}
+        self.status = 'pending'
+        self.error = None
+        self.deployment = None
+        self.output = {}
+        self.created = time.time()
+        self.updated = self.created
+        # operations on the same stack must not overlap
+        self.lock = threading.Lock()
+
+    def set_status(self, status, error=None):
+        self.status = status
+        self.error = error
+        self.updated = time.time()
+
+    def to_dict(self, verbose=False):
+        result = dict(id=self.id, scenario=self.scenario['file_name'],
+                      status=self.status, error=self.error,
+                      created=self.created, updated=self.updated)
+        if self.deployment is not None:
+            result['stack_id'] = self.deployment.stack_id
+        if verbose:
+            for key in ('agents', 'state_file', 'vsperf_manifest'):
+                if key in self.output:
+                    result[key] = self.output[key]
+        return result
+
+
+class DeploymentService(object):
+    """
+    Deploy, scale and tear down scenarios with shared OpenStack clients
+    """
+    def __init__(self, max_workers=8):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers)
+        self.jobs = {}
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def get_client(self, openstack_params):
+        """
+        Connected client for the parameters, created on first use
+        """
+        if (S.hasValue('OS_CASSETTE_REPLAY') or
+                S.hasValue('OS_CASSETTE_RECORD')):
+            # cassettes belong to a single deployment
+            return None
+        key = json.dumps(openstack_params, sort_keys=True)
+        with self._lock:
+            client = self._clients.get(key)
+        if client is None:
+            client = newdeploy.create_openstack_client(openstack_params)
+            with self._lock:
+                client = self._clients.setdefault(key, client)
+        return client
+
+    def _get_job(self, job_id):
+        job = self.jobs.get(job_id)
+        if job is None:
+            raise ServiceException(404, 'Deployment %s is not found' % job_id)
+        return job
+
+    def _submit(self, job, status, fn, *args):
+        job.set_status(status)
+        # workers run in a copy of the current settings context
+        self.executor.submit(contextvars.copy_context().run, self._run,
+                             job, fn, *args)
+
+    def _run(self, job, fn, *args):
+        with job.lock, S.overlay(job.scenario.get('settings')), \
+                S.overlay(job.settings):
+            S.setValue('LOG_TIMESTAMP', '%s_%s' % (
+                S.getValue('LOG_TIMESTAMP'), job.id))
+            S.setValue('INVENTORY_CACHE_TTL',
+                       S.getValue('SERVICE_INVENTORY_CACHE_TTL'))
+            try:
+                fn(job, *args)
+            except Exception as e:
+                LOG.exception(e)
+                job.set_status('failed', str(e))
+
+    def _deploy(self, job):
+        client = self.get_client(utils.pack_openstack_params())
+        job.deployment = newdeploy.Deployment(openstack_client=client)
+        job.output = newdeploy.play_scenario(job.scenario, job.deployment)
+        if job.output.get('agents'):
+            job.set_status('deployed')
+        else:
+            job.set_status('failed', job.output.get('error'))
+
+    def _scale(self, job, accommodation):
+        agents = newdeploy._extend_agents(
+            job.deployment.scale(accommodation))
+        job.output['agents'] = agents
+        if agents and S.getValue('VSPERF_TRAFFICGENS'):
+            job.output['vsperf_manifest'] = newdeploy.create_vsperf_conffile(
+                agents)
+        job.set_status('deployed')
+
+    def _teardown(self, job):
+        job.deployment.teardown()
+        job.output['agents'] = {}
+        job.set_status('deleted')
+
+    def deploy(self, request):
+        if not request.get('scenario'):
+            raise ServiceException(400, 'Scenario is not specified')
+        settings = request.get('settings') or {}
+        if not isinstance(settings, dict):
+            raise ServiceException(400, 'Settings must be an object')
+        check_settings(settings)
+        try:
+            scenario = newdeploy.read_scenario(request['scenario'])
+        except Exception as e:
+            raise ServiceException(400, 'Invalid scenario %s: %s' %
+                                   (request['scenario'], e))
+        # the client picks the scenario file, its settings are limited too
+        check_settings(scenario.get('settings') or {},
+                       'of scenario %s ' % request['scenario'])
+        job = Job(utils.random_string(), scenario, settings)
+        self.jobs[job.id] = job
+        self._submit(job, 'deploying', self._deploy)
+        return job.to_dict()
+
+    def scale(self, job_id, request):
+        job = self._get_job(job_id)
+        if job.status != 'deployed':
+            raise ServiceException(409, 'Deployment %s is %s' %
+                                   (job_id, job.status))
+        self._submit(job, 'scaling', self._scale, request)
+        return job.to_dict()
+
+    def teardown(self, job_id):
+        job = self._get_job(job_id)
+        if job.deployment is None or job.status in ('deleting', 'deleted'):
+            raise ServiceException(409, 'Deployment %s is %s' %
+                                   (job_id, job.status))
+        self._submit(job, 'deleting', self._teardown)
+        return job.to_dict()
+
+    def status(self, job_id=None):
+        if job_id is None:
+            return [job.to_dict() for job in self.jobs.values()]
+        return self._get_job(job_id).to_dict(verbose=True)
+
+    def metrics(self):
+        with self._lock:
+            clients = list(self._clients.values())
+        return ''.join(client.metrics.to_prometheus() for client in clients)
+
+    def handle(self, method, path, body):
+        """
+        Dispatch API request
+
+        :returns: (HTTP status code, response body)
+        """
+        path = path.split('?', 1)[0].rstrip('/')
+        match = re.match(r'^/deployments(?:/(?P<id>\w+))?(?P<scale>/scale)?$',
+                         path)
+        if method == 'GET' and path == '/metrics':
+            return 200, self.metrics()
+        if not match:
+            raise ServiceException(404, 'Unknown path %s' % path)
+
+        job_id = match.group('id')
+        if method == 'GET' and not match.group('scale'):
+            return 200, self.status(job_id)
+        if method == 'POST' and job_id is None:
+            return 202, self.deploy(body)
+        if method == 'POST' and job_id and match.group('scale'):
+            return 202, self.scale(job_id, body)
+        if method == 'DELETE' and job_id and not match.group('scale'):
+            return 202, self.teardown(job_id)
+        raise ServiceException(405, 'Method %s is not allowed for %s' %
+                               (method, path))
+
+
+class RequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    JSON over HTTP front-end of the deployment service
+    """
+    server_version = 'newdeployd'
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        LOG.debug('%s - %s', self.address_string(), format % args)
+
+    def _reply(self, code, body):
+        if isinstance(body, str):
+            data = body.encode('utf-8')
+            content_type = 'text/plain; version=0.0.4'
+        else:
+            data = json.dumps(body).encode('utf-8')
+            content_type = 'application/json'
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _handle(self):
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+            body = json.loads(self.rfile.read(length) or b'{}')
+            if not isinstance(body, dict):
+                raise ValueError('request body must be an object')
+        except ValueError as e:
+            return self._reply(400, dict(error='Invalid request: %s' % e))
+        try:
+            code, result = self.server.service.handle(self.command,
+                                                      self.path, body)
+        except ServiceException as e:
+            code, result = e.code, dict(error=str(e))
+        except Exception as e:
+            LOG.exception(e)
+            code, result = 500, dict(error=str(e))
+        self._reply(code, result)
+
+    do_GET = _handle
+    do_POST = _handle
+    do_DELETE = _handle
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn,
+                              socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+        os.makedirs(os.path.dirname(self.server_address) or '.',
+                    mode=0o700, exist_ok=True)
+        # the socket must not be accessible even before chmod
+        umask = os.umask(0o177)
+        try:
+            socketserver.UnixStreamServer.server_bind(self)
+        finally:
+            os.umask(umask)
+        os.chmod(self.server_address, 0o600)
+
+
+def create_server(service, listen=None, socket_path=None):
+    """
+    HTTP server of the service on Unix socket or TCP address
+    """
+    if socket_path:
+        server = ThreadingUnixHTTPServer(os.path.expanduser(socket_path),
+                                         RequestHandler)
+    elif not listen:
+        raise ValueError('Neither socket nor address to listen on is given')
+    else:
+        host, _sep, port = listen.rpartition(':')
+        server = http.server.ThreadingHTTPServer((host or '127.0.0.1',
+                                                  int(port)), RequestHandler)
+    server.service = service
+    return server
+
+
+def parse_arguments():
+    """
+    Parse command line arguments
+    """
+    parser = argparse.ArgumentParser(description='TestVNF deployment service')
+    parser.add_argument('--listen', help='host:port to listen on, without '
+                        'any authentication')
+    parser.add_argument('--socket', help='Unix socket to listen on')
+    parser.add_argument('--workers', type=int,
+                        help='number of requests processed concurrently')
+    return parser.parse_args()
+
+
+def main():
+    """Main function.
+    """
+    args = parse_arguments()
+
+    # define the timestamp to be used by logs and results
+    date = datetime.datetime.fromtimestamp(time.time())
+    S.setValue('LOG_TIMESTAMP', date.strftime('%Y-%m-%d_%H-%M-%S'))
+
+    # configure settings
+    S.load_from_dir(os.path.join(_CURR_DIR, 'conf'))
+
+    service = DeploymentService(
+        max_workers=args.workers or S.getValue('SERVICE_WORKERS'))
+    # TCP has no access control, it is used only when asked for
+    socket_path = args.socket or (
+        not args.listen and S.hasValue('SERVICE_SOCKET') and
+        S.getValue('SERVICE_SOCKET'))
+    listen = args.listen or (S.hasValue('SERVICE_LISTEN') and
+                             S.getValue('SERVICE_LISTEN'))
+    server = create_server(service, listen=listen, socket_path=socket_path)
+    LOG.info('Deployment service is listening on %s', server.server_address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        LOG.info('Caught SIGINT. Terminating')
+    finally:
+        server.server_close()
+        service.executor.shutdown(wait=False)
+
+
+if __name__ == "__main__":
+    main()
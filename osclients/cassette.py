@@ -0,0 +1,189 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import functools
+import gzip
+import json
+import threading
+import time
+
+from glanceclient import client as glance_client_pkg
+from heatclient import client as heat_client_pkg
+from keystoneauth1 import exceptions as ks_exceptions
+from keystoneauth1 import session as ks_session
+from neutronclient.v2_0 import client as neutron_client_pkg
+from novaclient import client as nova_client_pkg
+from oslo_log import log as logging
+import requests
+
+from osclients import metrics as metrics_pkg
+
+LOG = logging.getLogger(__name__)
+
+CASSETTE_VERSION = 1
+
+# response headers which are needed by the clients, everything else
+# (including tokens) is not recorded
+_RECORDED_HEADERS = ('content-type', 'location', 'x-openstack-request-id',
+                     'openstack-api-version', 'x-openstack-nova-api-version')
+
+
+class CassetteException(Exception):
+    pass
+
+
+def _service_type(kwargs):
+    return (kwargs.get('service_type') or
+            (kwargs.get('endpoint_filter') or {}).get('service_type'))
+
+
+def _key(service, method, url):
+    return '%s %s %s' % (service, method.upper(), url)
+
+
+class Recorder(object):
+    """Records API responses sent through keystoneauth session.
+
+    Authentication requests are not recorded, the replay session does
+    not need them.
+    """
+
+    def __init__(self, metadata=None):
+        self.metadata = dict(metadata or {})
+        self.interactions = []
+        self._lock = threading.Lock()
+        self._start = time.time()
+
+    def attach(self, session):
+        request = session.request
+
+        @functools.wraps(request)
+        def recording_request(url, method, **kwargs):
+            service = _service_type(kwargs)
+            start = time.time()
+            response = request(url, method, **kwargs)
+            elapsed = time.time() - start
+            if service:
+                headers = dict((k, v) for k, v in response.headers.items()
+                               if k.lower() in _RECORDED_HEADERS)
+                with self._lock:
+                    self.interactions.append(dict(
+                        key=_key(service, method, url),
+                        offset=round(start - self._start, 6),
+                        elapsed=round(elapsed, 6),
+                        status=response.status_code, headers=headers,
+                        body=response.content.decode('utf-8', 'replace')))
+            return response
+
+        session.request = recording_request
+        return session
+
+    def save(self, cassette_file):
+        with self._lock:
+            data = dict(version=CASSETTE_VERSION, metadata=self.metadata,
+                        interactions=list(self.interactions))
+        with gzip.open(cassette_file, 'wt') as fd:
+            json.dump(data, fd, separators=(',', ':'))
+        LOG.info('%d API interactions are recorded into %s',
+                 len(data['interactions']), cassette_file)
+
+
+def load_cassette(cassette_file):
+    with gzip.open(cassette_file, 'rt') as fd:
+        data = json.load(fd)
+    if data.get('version') != CASSETTE_VERSION:
+        raise CassetteException('Unsupported cassette version: %s' %
+                                data.get('version'))
+    return data
+
+
+class ReplaySession(ks_session.Session):
+    """Session answering requests from a recorded cassette.
+
+    Responses for the same service, method and URL are returned in the
+    recorded order. With ``realtime`` set the recorded latencies are
+    reproduced, otherwise responses are returned immediately.
+    """
+
+    def __init__(self, cassette, realtime=False):
+        super(ReplaySession, self).__init__()
+        self.metadata = cassette.get('metadata', {})
+        self.realtime = realtime
+        self._lock = threading.Lock()
+        self._queues = collections.defaultdict(collections.deque)
+        for interaction in cassette['interactions']:
+            self._queues[interaction['key']].append(interaction)
+
+    def request(self, url, method, **kwargs):
+        key = _key(_service_type(kwargs), method, url)
+        with self._lock:
+            queue = self._queues.get(key)
+            if not queue:
+                raise CassetteException('No recorded response for %s' % key)
+            # the last response is repeated, e.g. for additional polling
+            interaction = queue.popleft() if len(queue) > 1 else queue[0]
+
+        if self.realtime:
+            time.sleep(interaction['elapsed'])
+
+        response = requests.models.Response()
+        response.status_code = interaction['status']
+        response.headers.update(interaction['headers'])
+        response._content = interaction['body'].encode('utf-8')
+        response._content_consumed = True
+        response.url = url
+        response.encoding = 'utf-8'
+
+        if kwargs.get('raise_exc', True) and response.status_code >= 400:
+            raise ks_exceptions.from_response(response, method, url)
+        return response
+
+    def get_endpoint(self, *args, **kwargs):
+        return 'http://replay/%s' % kwargs.get('service_type', '')
+
+    def get_token(self, *args, **kwargs):
+        return 'replay'
+
+    def get_auth_headers(self, *args, **kwargs):
+        return {'X-Auth-Token': 'replay'}
+
+    def get_project_id(self, *args, **kwargs):
+        return self.metadata.get('project_id', 'replay')
+
+    def get_user_id(self, *args, **kwargs):
+        return self.metadata.get('user_id', 'replay')
+
+    def invalidate(self, *args, **kwargs):
+        return True
+
+
+class ReplayClient(object):
+    """Drop-in replacement of OpenStackClient fed from a cassette."""
+
+    def __init__(self, cassette_file, realtime=False, metrics=None):
+        LOG.info('Replaying OpenStack API from %s', cassette_file)
+        self.metrics = metrics or metrics_pkg.Metrics()
+        self.keystone_session = ReplaySession(load_cassette(cassette_file),
+                                              realtime=realtime)
+        self.metrics.instrument(self.keystone_session)
+        self.metadata = self.keystone_session.metadata
+
+        session = self.keystone_session
+        self.nova = nova_client_pkg.Client('2', session=session)
+        self.neutron = neutron_client_pkg.Client(session=session)
+        self.glance = glance_client_pkg.Client('2', session=session)
+        self.heat = heat_client_pkg.Client(
+            '1', session=session,
+            endpoint_override=session.get_endpoint(
+                service_type='orchestration'))
@@ -13,13 +13,46 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from glanceclient import exc as glance_exc
+
 
 def get_image(glance_client, image_name):
-    for image in glance_client.images.list():
-        if image.name == image_name:
-            return image
+    # filter by name on the server side, listing all images is expensive
+    for image in glance_client.images.list(filters={'name': image_name},
+                                           limit=1):
+        return image
     return None
 
 
+def get_image_by_id(glance_client, image_id):
+    try:
+        return glance_client.images.get(image_id)
+    except glance_exc.HTTPNotFound:
+        return None
+
+
+def get_image_id(glance_client, image_name_or_id):
+    image = get_image(glance_client, image_name_or_id)
+    if image is None:
+        image = get_image_by_id(glance_client, image_name_or_id)
+    return image.id if image else None
+
+
+def set_image_properties(glance_client, image_id, properties):
+    """Set properties of the image which differ, return the changed ones."""
+    image = glance_client.images.get(image_id)
+    changed = {}
+    for key, value in properties.items():
+        # Glance stores booleans as lower case strings
+        if isinstance(value, bool):
+            value = str(value).lower()
+        value = str(value)
+        if image.get(key) != value:
+            changed[key] = value
+    if changed:
+        glance_client.images.update(image_id, **changed)
+    return changed
+
+
 def get_supported_versions(glance_client):
     return set(version['id'] for version in glance_client.versions.list())
@@ -25,33 +25,59 @@ LOG = logging.getLogger(__name__)
 
 
 def create_stack(heat_client, stack_name, template, parameters,
-                 environment=None):
+                 environment=None, poll_interval=5, files=None, wait=True):
     stack_params = {
         'stack_name': stack_name,
         'template': template,
         'parameters': parameters,
         'environment': environment,
+        'files': files or {},
     }
 
     stack = heat_client.stacks.create(**stack_params)['stack']
     LOG.info('New stack: %s', stack)
 
-    wait_stack_completion(heat_client, stack['id'])
+    if wait:
+        wait_stack_completion(heat_client, stack['id'],
+                              poll_interval=poll_interval)
 
     return stack['id']
 
 
-def get_stack_status(heat_client, stack_id):
+def update_stack(heat_client, stack_id, template, parameters,
+                 environment=None, poll_interval=5, files=None):
+    stack_params = {
+        'template': template,
+        'parameters': parameters,
+        'environment': environment,
+        'files': files or {},
+    }
+
+    heat_client.stacks.update(stack_id, **stack_params)
+    LOG.info('Updating stack: %s', stack_id)
+
+    wait_stack_completion(heat_client, stack_id, action='UPDATE',
+                          poll_interval=poll_interval)
+
+    return stack_id
+
+
+def _find_stack(heat_client, stack_id):
     # stack.get operation may take long time and run out of time. The reason
     # is that it resolves all outputs which is done serially. On the other hand
     # stack status can be retrieved from the list operation. Internally listing
     # supports paging and every request should not take too long.
     for stack in heat_client.stacks.list():
         if stack.id == stack_id:
-            return stack.status, stack.stack_status_reason
+            return stack
     raise exc.HTTPNotFound(message='Stack %s is not found' % stack_id)
 
 
+def get_stack_status(heat_client, stack_id):
+    stack = _find_stack(heat_client, stack_id)
+    return stack.status, stack.stack_status_reason
+
+
 def get_id_with_name(heat_client, stack_name):
     # This method isn't really necessary since the Heat client accepts
     # stack_id and stack_name interchangeably. This is provided more as a
@@ -62,17 +88,22 @@ def get_id_with_name(heat_client, stack_name):
     return stack.id
 
 
-def wait_stack_completion(heat_client, stack_id):
+def wait_stack_completion(heat_client, stack_id, action=None,
+                          poll_interval=5):
     reason = None
     status = None
 
     while True:
-        status, reason = get_stack_status(heat_client, stack_id)
+        stack = _find_stack(heat_client, stack_id)
+        status, reason = stack.status, stack.stack_status_reason
         LOG.debug('Stack status: %s', status)
-        if status not in ['IN_PROGRESS', '']:
+        # the engine may not have switched the stack to the requested
+        # action yet, the status then belongs to the previous action
+        if (status not in ['IN_PROGRESS', ''] and
+                (action is None or stack.action == action)):
             break
 
-        time.sleep(5)
+        time.sleep(poll_interval)
 
     if status != 'COMPLETE':
         resources = heat_client.resources.list(stack_id)
@@ -88,6 +119,49 @@ def wait_stack_completion(heat_client, stack_id):
         raise exc.StackFailure(stack_id, status, reason)
 
 
+def iter_complete_resources(heat_client, stack_id, resource_type=None,
+                            action='CREATE', poll_interval=5):
+    # yield logical names of resources as they complete, until the whole
+    # stack is done; the stack failure is raised after the resources which
+    # did complete are yielded
+    seen = set()
+    while True:
+        # status of the stack first, so the last listing has all resources
+        stack = _find_stack(heat_client, stack_id)
+        for res in heat_client.resources.list(stack_id):
+            if resource_type and res.resource_type != resource_type:
+                continue
+            if (res.resource_status == '%s_COMPLETE' % action and
+                    res.logical_resource_id not in seen):
+                seen.add(res.logical_resource_id)
+                yield res.logical_resource_id
+        LOG.debug('Stack status: %s, %d resources complete', stack.status,
+                  len(seen))
+        if (stack.status not in ['IN_PROGRESS', ''] and
+                stack.action == action):
+            break
+        time.sleep(poll_interval)
+
+    if stack.status != 'COMPLETE':
+        raise exc.StackFailure(stack_id, stack.status,
+                               stack.stack_status_reason)
+
+
+def get_failed_resources(heat_client, stack_id):
+    return [res.logical_resource_id
+            for res in heat_client.resources.list(stack_id)
+            if res.resource_status.endswith('FAILED')]
+
+
+# failed members of resource groups as (group, member name) pairs, the member
+# names are the indexes of the group
+def get_failed_group_members(heat_client, stack_id):
+    return [(res.parent_resource, res.logical_resource_id)
+            for res in heat_client.resources.list(stack_id, nested_depth=1)
+            if getattr(res, 'parent_resource', None) and
+            res.resource_status.endswith('FAILED')]
+
+
 # set the timeout for this method so we don't get stuck polling indefinitely
 # waiting for a delete
 @timeout(600)
@@ -113,6 +187,26 @@ def wait_stack_deletion(heat_client, stack_id):
         LOG.info('Stack %s was successfully deleted', stack_id)
 
 
+def delete_stack(heat_client, stack_id, timeout=600, poll_interval=5):
+    # unlike wait_stack_deletion it does not rely on signals, so it can be
+    # called from worker threads
+    heat_client.stacks.delete(stack_id)
+    deadline = time.time() + timeout
+    try:
+        while time.time() < deadline:
+            stack = _find_stack(heat_client, stack_id)
+            LOG.debug('Stack status: %s', stack.status)
+            if stack.action == 'DELETE' and stack.status == 'FAILED':
+                raise exc.StackFailure(stack_id, stack.status,
+                                       stack.stack_status_reason)
+            time.sleep(poll_interval)
+    except exc.HTTPNotFound:
+        LOG.info('Stack %s was successfully deleted', stack_id)
+        return
+    raise TimeoutError('Timed out waiting for deletion of stack %s' %
+                       stack_id)
+
+
 def get_stack_outputs(heat_client, stack_id):
     # try to use optimized way to retrieve outputs, fallback otherwise
     if hasattr(heat_client.stacks, 'output_list'):
@@ -132,3 +226,16 @@ def get_stack_outputs(heat_client, stack_id):
     outputs_list = heat_client.stacks.get(stack_id).to_dict()['outputs']
     return dict((item['output_key'], item['output_value'])
                 for item in outputs_list)
+
+
+def get_stack_output_values(heat_client, stack_id, output_keys):
+    # outputs are resolved one by one, so outputs of resources created
+    # early can be read while the rest of the stack is in progress
+    result = {}
+    for output_key in output_keys:
+        try:
+            value = heat_client.stacks.output_show(stack_id, output_key)
+        except exc.HTTPNotFound:
+            continue
+        result[output_key] = value['output'].get('output_value')
+    return result
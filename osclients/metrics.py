@@ -0,0 +1,196 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import functools
+import json
+import re
+import threading
+import time
+from urllib import parse as urlparse
+
+from oslo_log import log as logging
+
+LOG = logging.getLogger(__name__)
+
+# upper bounds of latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0, 60.0)
+
+_ID_SEGMENT = re.compile(r'^([0-9a-fA-F]{32}|[0-9a-fA-F-]{36}|\d+)$')
+# segments following these ones are names chosen by the user
+_NAMED_COLLECTIONS = ('stacks', 'outputs', 'resources', 'events')
+
+
+def normalize_path(url):
+    segments = urlparse.urlparse(url).path.split('/')
+    result = []
+    for segment in segments:
+        if _ID_SEGMENT.match(segment):
+            segment = '{id}'
+        elif result and result[-1] in _NAMED_COLLECTIONS:
+            segment = '{name}'
+        result.append(segment)
+    return '/'.join(result) or '/'
+
+
+def _service_type(url, kwargs):
+    service = (kwargs.get('service_type') or
+               (kwargs.get('endpoint_filter') or {}).get('service_type'))
+    if service:
+        return service
+    if '/auth/tokens' in url:
+        return 'identity'
+    return urlparse.urlparse(url).netloc
+
+
+def _response_size(response, stream):
+    length = response.headers.get('Content-Length')
+    if length is not None:
+        return int(length)
+    if stream:
+        return 0
+    return len(response.content or b'')
+
+
+class _OperationStats(object):
+    __slots__ = ('count', 'errors', 'retries', 'latency_sum', 'buckets',
+                 'bytes')
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.retries = 0
+        self.latency_sum = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.bytes = 0
+
+
+class Metrics(object):
+    """Per service and per operation statistics of OpenStack API calls.
+
+    Operations are identified by HTTP method and URL path with IDs and
+    names replaced by placeholders, e.g. ``GET /v1/{id}/stacks``.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def _get(self, service, operation):
+        key = (service, operation)
+        stats = self._stats.get(key)
+        if stats is None:
+            stats = self._stats.setdefault(key, _OperationStats())
+        return stats
+
+    def record(self, service, operation, latency, size=0, error=False):
+        with self._lock:
+            stats = self._get(service, operation)
+            stats.count += 1
+            stats.errors += int(error)
+            stats.latency_sum += latency
+            stats.bytes += size
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if latency <= bound:
+                    stats.buckets[i] += 1
+                    break
+            else:
+                stats.buckets[-1] += 1
+
+    def record_retry(self, service, operation):
+        with self._lock:
+            self._get(service, operation).retries += 1
+
+    def instrument(self, session):
+        """Record every request sent through keystoneauth ``session``."""
+        request = session.request
+
+        @functools.wraps(request)
+        def instrumented_request(url, method, **kwargs):
+            service = _service_type(url, kwargs)
+            operation = '%s %s' % (method.upper(), normalize_path(url))
+            start = time.time()
+            try:
+                response = request(url, method, **kwargs)
+            except Exception:
+                self.record(service, operation, time.time() - start,
+                            error=True)
+                raise
+            self.record(service, operation, time.time() - start,
+                        _response_size(response, kwargs.get('stream')),
+                        error=response.status_code >= 400)
+            return response
+
+        session.request = instrumented_request
+        return session
+
+    def summary(self):
+        with self._lock:
+            items = sorted(self._stats.items())
+        result = []
+        for (service, operation), stats in items:
+            result.append(dict(
+                service=service, operation=operation, count=stats.count,
+                errors=stats.errors, retries=stats.retries,
+                latency_sum=stats.latency_sum,
+                latency_avg=stats.latency_sum / max(stats.count, 1),
+                bytes=stats.bytes,
+                latency_buckets=dict(zip(
+                    [str(b) for b in LATENCY_BUCKETS] + ['+Inf'],
+                    stats.buckets))))
+        return result
+
+    def to_prometheus(self):
+        lines = [
+            '# HELP openstack_api_requests_total Number of API requests.',
+            '# TYPE openstack_api_requests_total counter',
+            '# HELP openstack_api_errors_total Number of failed API requests.',
+            '# TYPE openstack_api_errors_total counter',
+            '# HELP openstack_api_retries_total Number of retried requests.',
+            '# TYPE openstack_api_retries_total counter',
+            '# HELP openstack_api_response_bytes_total Size of responses.',
+            '# TYPE openstack_api_response_bytes_total counter',
+            '# HELP openstack_api_latency_seconds Latency of API requests.',
+            '# TYPE openstack_api_latency_seconds histogram',
+        ]
+        for item in self.summary():
+            labels = 'service="%s",operation="%s"' % (
+                item['service'], item['operation'].replace('"', '\\"'))
+            lines.append('openstack_api_requests_total{%s} %d' %
+                         (labels, item['count']))
+            lines.append('openstack_api_errors_total{%s} %d' %
+                         (labels, item['errors']))
+            lines.append('openstack_api_retries_total{%s} %d' %
+                         (labels, item['retries']))
+            lines.append('openstack_api_response_bytes_total{%s} %d' %
+                         (labels, item['bytes']))
+            cumulative = 0
+            for bound, count in item['latency_buckets'].items():
+                cumulative += count
+                lines.append('openstack_api_latency_seconds_bucket'
+                             '{%s,le="%s"} %d' % (labels, bound, cumulative))
+            lines.append('openstack_api_latency_seconds_sum{%s} %f' %
+                         (labels, item['latency_sum']))
+            lines.append('openstack_api_latency_seconds_count{%s} %d' %
+                         (labels, item['count']))
+        return '\n'.join(lines) + '\n'
+
+    def export(self, prometheus_file=None, json_file=None):
+        if prometheus_file:
+            with open(prometheus_file, 'w') as fd:
+                fd.write(self.to_prometheus())
+        if json_file:
+            with open(json_file, 'w') as fd:
+                json.dump(self.summary(), fd, indent=2)
+        LOG.info('OpenStack API metrics are exported to %s',
+                 ', '.join(filter(None, [prometheus_file, json_file])))
@@ -21,7 +21,30 @@ LOG = logging.getLogger(__name__)
 
 def choose_external_net(neutron_client):
     ext_nets = neutron_client.list_networks(
-        **{'router:external': True})['networks']
+        fields=['id', 'name'], **{'router:external': True})['networks']
     if not ext_nets:
         raise Exception('No external networks found')
     return ext_nets[0]['name']
+
+
+def get_network_id(neutron_client, network_name_or_id):
+    nets = neutron_client.list_networks(
+        name=network_name_or_id, fields=['id'])['networks']
+    if not nets:
+        nets = neutron_client.list_networks(
+            id=network_name_or_id, fields=['id'])['networks']
+    if not nets:
+        return None
+    if len(nets) > 1:
+        raise Exception('Network name %s is ambiguous' % network_name_or_id)
+    return nets[0]['id']
+
+
+def get_network_by_id(neutron_client, network_id):
+    nets = neutron_client.list_networks(
+        id=network_id, fields=['id', 'name'])['networks']
+    return nets[0] if nets else None
+
+
+def get_quota_details(neutron_client, project_id):
+    return neutron_client.show_quota_details(project_id)['quota']
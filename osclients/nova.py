@@ -27,7 +27,7 @@ class ForbiddenException(nova_client_pkg.exceptions.Forbidden):
     pass
 
 
-def get_available_compute_nodes(nova_client, flavor_name):
+def get_available_compute_nodes(nova_client, flavor_name, flavor_id=None):
     try:
         host_list = [dict(host=svc.host, zone=svc.zone)
                      for svc in
@@ -36,7 +36,10 @@ def get_available_compute_nodes(nova_client, flavor_name):
 
         # If the flavor has aggregate_instance_extra_specs set then filter
         # host_list to pick only the hosts matching the chosen flavor.
-        flavor = get_flavor(nova_client, flavor_name)
+        if flavor_id:
+            flavor = get_flavor_by_id(nova_client, flavor_id)
+        else:
+            flavor = get_flavor(nova_client, flavor_name)
 
         if flavor is not None:
             extra_specs = flavor.get_keys()
@@ -71,6 +74,17 @@ def get_available_compute_nodes(nova_client, flavor_name):
         raise ForbiddenException(msg)
 
 
+def get_host_racks(nova_client, metadata_key):
+    # racks are described by host aggregates carrying the metadata key
+    racks = {}
+    for agg in nova_client.aggregates.list():
+        rack = agg.metadata.get(metadata_key)
+        if rack:
+            for host in agg.hosts:
+                racks[host] = rack
+    return racks
+
+
 def does_flavor_exist(nova_client, flavor_name):
     for flavor in nova_client.flavors.list():
         if flavor.name == flavor_name:
@@ -80,12 +94,45 @@ def does_flavor_exist(nova_client, flavor_name):
 
 def create_flavor(nova_client, **kwargs):
     try:
-        nova_client.flavors.create(**kwargs)
+        return nova_client.flavors.create(**kwargs)
     except nova_client_pkg.exceptions.Forbidden:
         msg = 'Forbidden to create flavor'
         raise ForbiddenException(msg)
 
 
+def flavor_matches(flavor, vcpus, ram, disk, extra_specs):
+    return (flavor.vcpus == vcpus and flavor.ram == ram and
+            flavor.disk == disk and
+            flavor.get_keys() == dict((k, str(v))
+                                      for k, v in extra_specs.items()))
+
+
+def ensure_flavor(nova_client, name, vcpus, ram, disk=0, extra_specs=None):
+    """Create flavor with the extra specs unless it exists already.
+
+    :returns: tuple (flavor, created)
+    """
+    extra_specs = extra_specs or {}
+    flavor = get_flavor(nova_client, name)
+    if flavor is not None:
+        return flavor, False
+
+    try:
+        flavor = create_flavor(nova_client, name=name, ram=ram, vcpus=vcpus,
+                               disk=disk)
+    except nova_client_pkg.exceptions.Conflict:
+        # created by a concurrent run meanwhile
+        return get_flavor(nova_client, name), False
+    try:
+        flavor.set_keys(dict((k, str(v)) for k, v in extra_specs.items()))
+    except nova_client_pkg.exceptions.ClientException:
+        # flavor without its extra specs would skew the results
+        flavor.delete()
+        raise
+    LOG.info('Flavor %s is created with extra specs %s', name, extra_specs)
+    return flavor, True
+
+
 def get_server_ip(nova_client, server_name, ip_type):
     server = nova_client.servers.find(name=server_name)
     addresses = server.addresses
@@ -157,6 +204,39 @@ def _poll_for_status(nova_client, server_id, final_ok_states, poll_period=20,
         time.sleep(poll_period)
 
 
+def create_server(nova_client, name, image_id, flavor_id, availability_zone,
+                  network_id=None):
+    nics = [{'net-id': network_id}] if network_id else None
+    server = nova_client.servers.create(name, image_id, flavor_id,
+                                        availability_zone=availability_zone,
+                                        nics=nics)
+    return server.id
+
+
+def wait_server_active(nova_client, server_id, timeout=600, poll_period=5):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        server = nova_client.servers.get(server_id)
+        LOG.debug('Instance %(id)s has status %(status)s',
+                  dict(id=server_id, status=server.status))
+        if server.status == 'ACTIVE':
+            return
+        if server.status == 'ERROR':
+            fault = getattr(server, 'fault', None) or {}
+            raise Exception(fault.get('message') or
+                            'Instance %s failed' % server_id)
+        time.sleep(poll_period)
+    raise Exception('Instance %s is not active after %d seconds' %
+                    (server_id, timeout))
+
+
+def delete_server(nova_client, server_id):
+    try:
+        nova_client.servers.delete(server_id)
+    except nova_client_pkg.exceptions.NotFound:
+        pass
+
+
 def wait_server_shutdown(nova_client, server_id):
     _poll_for_status(nova_client, server_id, ['shutoff'])
 
@@ -174,3 +254,40 @@ def get_flavor(nova_client, flavor_name):
         if flavor.name == flavor_name:
             return flavor
     return None
+
+
+def get_flavor_by_id(nova_client, flavor_id):
+    try:
+        return nova_client.flavors.get(flavor_id)
+    except nova_client_pkg.exceptions.NotFound:
+        return None
+
+
+def get_flavor_id(nova_client, flavor_name_or_id):
+    # Nova API has no server side filter by flavor name
+    flavor = get_flavor(nova_client, flavor_name_or_id)
+    if flavor is None:
+        flavor = get_flavor_by_id(nova_client, flavor_name_or_id)
+    return flavor.id if flavor else None
+
+
+def get_absolute_limits(nova_client):
+    return dict((limit.name, limit.value)
+                for limit in nova_client.limits.get().absolute)
+
+
+def get_hypervisor_usage(nova_client):
+    result = {}
+    try:
+        for hv in nova_client.hypervisors.list():
+            service = getattr(hv, 'service', None) or {}
+            host = service.get('host') or hv.hypervisor_hostname
+            result[host] = dict(vcpus=getattr(hv, 'vcpus', None),
+                                vcpus_used=getattr(hv, 'vcpus_used', None),
+                                memory_mb=getattr(hv, 'memory_mb', None),
+                                memory_mb_used=getattr(hv, 'memory_mb_used',
+                                                       None))
+    except nova_client_pkg.exceptions.Forbidden:
+        msg = 'Forbidden to get list of hypervisors'
+        raise ForbiddenException(msg)
+    return result
@@ -13,9 +13,18 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import functools
+import hashlib
+import os
+import tempfile
+import threading
+
 import os_client_config
 from oslo_log import log as logging
 from oslo_utils import importutils
+from requests import adapters
+
+from osclients import metrics as metrics_pkg
 
 LOG = logging.getLogger(__name__)
 
@@ -37,10 +46,83 @@ def init_profiling(os_profile):
                         'please install "osprofiler" library')
 
 
+def auth_cache_file(cache_dir, openstack_params):
+    auth = openstack_params['auth']
+    key = '|'.join(str(v) for v in (
+        auth.get('auth_url'), auth.get('user_domain_name'),
+        auth.get('username'), auth.get('project_domain_name'),
+        auth.get('project_name'), openstack_params.get('os_region_name')))
+    return os.path.join(os.path.expanduser(cache_dir),
+                        hashlib.sha256(key.encode('utf-8')).hexdigest() +
+                        '.json')
+
+
+def load_auth_state(auth_plugin, cache_file, margin=300):
+    try:
+        with open(cache_file) as fd:
+            auth_plugin.set_auth_state(fd.read())
+    except (IOError, ValueError, KeyError) as e:
+        LOG.debug('Auth state %s is not loaded: %s', cache_file, e)
+        return False
+
+    auth_ref = auth_plugin.auth_ref
+    if auth_ref is None or auth_ref.will_expire_soon(margin):
+        LOG.debug('Cached token expires soon, authenticating again')
+        auth_plugin.invalidate()
+        return False
+    LOG.debug('Using cached auth state %s', cache_file)
+    return True
+
+
+def save_auth_state(auth_plugin, cache_file):
+    state = auth_plugin.get_auth_state()
+    if not state:
+        return
+    # the token is a credential, keep it private to the user
+    cache_dir = os.path.dirname(cache_file)
+    try:
+        os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix='.tmp_')
+        with os.fdopen(fd, 'w') as tmp_file:
+            tmp_file.write(state)
+        os.replace(tmp_path, cache_file)
+    except (IOError, OSError) as e:
+        LOG.warning('Failed to store auth state %s: %s', cache_file, e)
+
+
+def persist_auth_state(session, cache_file):
+    """Store auth state again whenever ``session`` re-authenticates."""
+    request = session.request
+    lock = threading.Lock()
+    saved = [session.auth.auth_ref]
+
+    @functools.wraps(request)
+    def persisting_request(url, method, **kwargs):
+        try:
+            return request(url, method, **kwargs)
+        finally:
+            # keystoneauth replaces auth_ref on expiry and after 401
+            auth_ref = session.auth.auth_ref
+            if auth_ref is not None and auth_ref is not saved[0]:
+                with lock:
+                    if auth_ref is not saved[0]:
+                        saved[0] = auth_ref
+                        save_auth_state(session.auth, cache_file)
+
+    session.request = persisting_request
+    return session
+
+
 class OpenStackClient(object):
-    def __init__(self, openstack_params):
+    def __init__(self, openstack_params, metrics=None, recorder=None,
+                 auth_cache_dir=None, auth_cache_margin=300, pool_size=None,
+                 rate_limiter=None):
         LOG.debug('Establishing connection to OpenStack')
 
+        # all service clients share the keystone session, instrumenting
+        # the session covers every API call
+        self.metrics = metrics or metrics_pkg.Metrics()
+
         init_profiling(openstack_params.get('os_profile'))
 
         config = os_client_config.OpenStackConfig()
@@ -49,6 +131,28 @@ class OpenStackClient(object):
             cloud_config.config['verify'] = False
             cloud_config.config['cacert'] = None
         self.keystone_session = cloud_config.get_session()
+        if pool_size:
+            # concurrent deployments share connections to every endpoint
+            adapter = adapters.HTTPAdapter(pool_connections=pool_size,
+                                           pool_maxsize=pool_size)
+            self.keystone_session.session.mount('https://', adapter)
+            self.keystone_session.session.mount('http://', adapter)
+
+        # token and service catalog of earlier runs are reused until they
+        # are about to expire, keystoneauth re-authenticates on 401
+        auth_cache = None
+        if auth_cache_dir and getattr(self.keystone_session.auth,
+                                      'set_auth_state', None):
+            auth_cache = auth_cache_file(auth_cache_dir, openstack_params)
+            load_auth_state(self.keystone_session.auth, auth_cache,
+                            auth_cache_margin)
+
+        if rate_limiter:
+            rate_limiter.metrics = rate_limiter.metrics or self.metrics
+            rate_limiter.instrument(self.keystone_session)
+        if recorder:
+            recorder.attach(self.keystone_session)
+        self.metrics.instrument(self.keystone_session)
         self.nova = cloud_config.get_legacy_client('compute')
         self.neutron = cloud_config.get_legacy_client('network')
         self.glance = cloud_config.get_legacy_client('image')
@@ -63,5 +167,8 @@ class OpenStackClient(object):
 
         # Ping OpenStack
         self.keystone_session.get_token()
+        if auth_cache:
+            save_auth_state(self.keystone_session.auth, auth_cache)
+            persist_auth_state(self.keystone_session, auth_cache)
 
         LOG.info('Connection to OpenStack is initialized')
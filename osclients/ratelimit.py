@@ -0,0 +1,139 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from email import utils as email_utils
+import functools
+import threading
+import time
+
+from keystoneauth1 import exceptions as ks_exceptions
+from oslo_log import log as logging
+
+from osclients import metrics as metrics_pkg
+
+LOG = logging.getLogger(__name__)
+
+RETRY_STATUS_CODES = (413, 429, 503)
+# 503 may be returned after the request was processed
+_IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+
+
+def _service_type(kwargs):
+    return (kwargs.get('service_type') or
+            (kwargs.get('endpoint_filter') or {}).get('service_type'))
+
+
+def parse_retry_after(value):
+    """Delay in seconds from Retry-After header (seconds or HTTP date)."""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        date = email_utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(date.timestamp() - time.time(), 0.0)
+
+
+class TokenBucket(object):
+    """Allows ``rate`` requests per second with bursts up to ``burst``."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or max(rate, 1))
+        self._tokens = self.burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst,
+                               self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            # the token is taken right away, waiters queue up behind
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+        return wait
+
+
+class RateLimiter(object):
+    """Throttles and retries requests sent through keystoneauth session.
+
+    ``limits`` maps service type to requests per second or to a pair
+    (rate, burst). Responses with status from ``retry_status_codes`` are
+    retried up to ``retries`` times after the delay requested by the
+    Retry-After header or after exponential back-off.
+    """
+
+    def __init__(self, limits=None, retries=5, max_delay=60,
+                 retry_status_codes=RETRY_STATUS_CODES, metrics=None):
+        self.buckets = {}
+        for service, limit in (limits or {}).items():
+            if isinstance(limit, (list, tuple)):
+                self.buckets[service] = TokenBucket(*limit)
+            else:
+                self.buckets[service] = TokenBucket(limit)
+        self.retries = retries
+        self.max_delay = max_delay
+        self.retry_status_codes = tuple(retry_status_codes)
+        self.metrics = metrics
+
+    def _retry_delay(self, response, attempt):
+        delay = parse_retry_after(response.headers.get('Retry-After'))
+        if delay is None:
+            delay = 2 ** attempt
+        return min(delay, self.max_delay)
+
+    def instrument(self, session):
+        request = session.request
+
+        @functools.wraps(request)
+        def limited_request(url, method, **kwargs):
+            service = _service_type(kwargs)
+            bucket = self.buckets.get(service)
+            raise_exc = kwargs.pop('raise_exc', True)
+            retry_status_codes = self.retry_status_codes
+            if method.upper() not in _IDEMPOTENT_METHODS:
+                retry_status_codes = tuple(
+                    c for c in retry_status_codes if c != 503)
+
+            for attempt in range(self.retries + 1):
+                if bucket:
+                    bucket.acquire()
+                response = request(url, method, raise_exc=False, **kwargs)
+                if (response.status_code not in retry_status_codes or
+                        attempt == self.retries):
+                    break
+                delay = self._retry_delay(response, attempt)
+                LOG.info('%(service)s returned %(status)s for %(method)s '
+                         '%(url)s, retrying in %(delay).1f s',
+                         dict(service=service, status=response.status_code,
+                              method=method, url=url, delay=delay))
+                if self.metrics:
+                    self.metrics.record_retry(
+                        metrics_pkg._service_type(url, kwargs), '%s %s' % (
+                            method.upper(), metrics_pkg.normalize_path(url)))
+                time.sleep(delay)
+
+            if raise_exc and response.status_code >= 400:
+                raise ks_exceptions.from_response(response, method, url)
+            return response
+
+        session.request = limited_request
+        return session
@@ -0,0 +1,169 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import fcntl
+import json
+import os
+import tempfile
+import time
+
+from oslo_log import log as logging
+
+from osclients import glance
+from osclients import neutron
+from osclients import nova
+
+LOG = logging.getLogger(__name__)
+
+
+class ResolverException(Exception):
+    pass
+
+
+class NameResolver(object):
+    """Resolves names of images, flavors and networks into IDs.
+
+    Results are cached for the lifetime of the resolver and, when
+    ``cache_file`` is given, on disk for ``cache_ttl`` seconds. Entries on
+    disk are kept separately for every ``scope`` (cloud, region, project).
+    IDs from the disk cache are checked with a GET before use, the name may
+    have been re-created with a new ID since they were stored.
+    """
+
+    def __init__(self, openstack_client, cache_file=None, cache_ttl=3600,
+                 scope=''):
+        self.openstack_client = openstack_client
+        self.cache_file = cache_file and os.path.expanduser(cache_file)
+        self.cache_ttl = cache_ttl
+        self.scope = scope
+        self._cache = {}
+        self._disk_cache = self._load()
+        # entries changed by this resolver, None for invalidated ones
+        self._changes = {}
+
+    def _lookup_fn(self, kind):
+        if kind == 'image':
+            return lambda name: glance.get_image_id(
+                self.openstack_client.glance, name)
+        if kind == 'flavor':
+            return lambda name: nova.get_flavor_id(
+                self.openstack_client.nova, name)
+        if kind == 'network':
+            return lambda name: neutron.get_network_id(
+                self.openstack_client.neutron, name)
+        raise ResolverException('Unknown kind of resource: %s' % kind)
+
+    def _get_fn(self, kind):
+        # returns the resource by ID as (id, name) or None if it is gone
+        if kind == 'image':
+            def get_image(resource_id):
+                image = glance.get_image_by_id(self.openstack_client.glance,
+                                               resource_id)
+                return image and (image.id, image.name)
+            return get_image
+        if kind == 'flavor':
+            def get_flavor(resource_id):
+                flavor = nova.get_flavor_by_id(self.openstack_client.nova,
+                                               resource_id)
+                return flavor and (flavor.id, flavor.name)
+            return get_flavor
+        if kind == 'network':
+            def get_network(resource_id):
+                net = neutron.get_network_by_id(
+                    self.openstack_client.neutron, resource_id)
+                return net and (net['id'], net['name'])
+            return get_network
+        raise ResolverException('Unknown kind of resource: %s' % kind)
+
+    def _is_valid(self, kind, name, resource_id):
+        found = self._get_fn(kind)(resource_id)
+        return bool(found) and name in found
+
+    def _load(self):
+        if not self.cache_file or not self.cache_ttl:
+            return {}
+        try:
+            with open(self.cache_file) as fd:
+                return json.load(fd)
+        except (IOError, ValueError) as e:
+            LOG.debug('Resolver cache %s is not loaded: %s',
+                      self.cache_file, e)
+            return {}
+
+    def _save(self):
+        if not self.cache_file or not self.cache_ttl:
+            return
+        cache_dir = os.path.dirname(self.cache_file)
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            # concurrent runs share the file, re-read it under the lock and
+            # apply own changes only, so entries of others are kept
+            with open(self.cache_file + '.lock', 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                disk_cache = self._load()
+                scoped = disk_cache.setdefault(self.scope, {})
+                for (kind, name), entry in self._changes.items():
+                    if entry is None:
+                        scoped.get(kind, {}).pop(name, None)
+                    else:
+                        scoped.setdefault(kind, {})[name] = entry
+                fd, tmp_path = tempfile.mkstemp(dir=cache_dir,
+                                                prefix='.tmp_')
+                with os.fdopen(fd, 'w') as tmp_file:
+                    json.dump(disk_cache, tmp_file)
+                os.replace(tmp_path, self.cache_file)
+            self._disk_cache = disk_cache
+            self._changes = {}
+        except (IOError, OSError) as e:
+            LOG.warning('Failed to store resolver cache %s: %s',
+                        self.cache_file, e)
+
+    def resolve(self, kind, name):
+        key = (kind, name)
+        if key in self._cache:
+            return self._cache[key]
+
+        entry = self._disk_cache.get(self.scope, {}).get(kind, {}).get(name)
+        if entry and time.time() - entry[1] < self.cache_ttl:
+            if self._is_valid(kind, name, entry[0]):
+                LOG.debug('Resolved %s %s to %s from cache',
+                          kind, name, entry[0])
+                self._cache[key] = entry[0]
+                return entry[0]
+            LOG.info('Cached %s %s (%s) is stale, resolving again',
+                     kind, name, entry[0])
+
+        resource_id = self._lookup_fn(kind)(name)
+        if not resource_id:
+            raise ResolverException('%s %s is not found' %
+                                    (kind.capitalize(), name))
+        LOG.debug('Resolved %s %s to %s', kind, name, resource_id)
+
+        self._cache[key] = resource_id
+        self._changes[key] = [resource_id, time.time()]
+        self._save()
+        return resource_id
+
+    def invalidate(self, kind, name):
+        self._cache.pop((kind, name), None)
+        self._changes[(kind, name)] = None
+        self._save()
+
+    def image(self, name):
+        return self.resolve('image', name)
+
+    def flavor(self, name):
+        return self.resolve('flavor', name)
+
+    def network(self, name):
+        return self.resolve('network', name)
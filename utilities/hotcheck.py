@@ -0,0 +1,319 @@
+"""
+Offline validation of rendered HOT templates.
+
+Catches the mistakes Heat would otherwise report only while the stack
+is being created: YAML broken by template rendering, references to
+missing resources and parameters, unknown attributes, parameter values
+of wrong type and missing outputs.
+"""
+
+import json
+import logging
+
+import netaddr
+import yaml
+
+LOG = logging.getLogger(__name__)
+
+PARAMETER_TYPES = ('string', 'number', 'json', 'comma_delimited_list',
+                   'boolean')
+PSEUDO_PARAMETERS = ('OS::stack_name', 'OS::stack_id', 'OS::project_id')
+
+# attributes of resource types used by the templates, other types are
+# not checked
+RESOURCE_ATTRIBUTES = {
+    'OS::Nova::Server': (
+        'accessIPv4', 'accessIPv6', 'addresses', 'console_urls',
+        'first_address', 'instance_name', 'name', 'networks',
+        'os_collect_config', 'tags'),
+    'OS::Neutron::Port': (
+        'admin_state_up', 'allowed_address_pairs', 'device_id',
+        'device_owner', 'dns_assignment', 'fixed_ips', 'mac_address', 'name',
+        'network_id', 'port_security_enabled', 'qos_policy_id',
+        'security_groups', 'status', 'subnets', 'tenant_id'),
+    'OS::Neutron::FloatingIP': (
+        'fixed_ip_address', 'floating_ip_address', 'floating_network_id',
+        'port_id', 'router_id', 'tenant_id'),
+    'OS::Neutron::Net': (
+        'admin_state_up', 'l2_adjacency', 'mtu', 'name',
+        'port_security_enabled', 'qos_policy_id', 'segments', 'status',
+        'subnets', 'tenant_id'),
+    'OS::Neutron::ProviderNet': (
+        'l2_adjacency', 'segments', 'status', 'subnets'),
+    'OS::Neutron::Subnet': (
+        'allocation_pools', 'cidr', 'dns_nameservers', 'enable_dhcp',
+        'gateway_ip', 'host_routes', 'ip_version', 'name', 'network_id',
+        'subnetpool_id', 'tenant_id'),
+    'OS::Neutron::Router': (
+        'admin_state_up', 'external_gateway_info', 'l3_agent_ids', 'name',
+        'status', 'tenant_id'),
+    'OS::Neutron::RouterInterface': (),
+    'OS::Neutron::SecurityGroup': (),
+    'OS::Heat::CloudConfig': ('config',),
+    'OS::Heat::ResourceGroup': ('refs', 'refs_map', 'removed_rsrc_list',
+                                'attributes'),
+}
+
+
+class TemplateError(Exception):
+    """
+    Template is invalid, carries all problems found
+    """
+    def __init__(self, errors):
+        super(TemplateError, self).__init__(
+            'Template is invalid:\n%s' % '\n'.join('  ' + e for e in errors))
+        self.errors = errors
+
+
+def _iter_functions(node, path):
+    """
+    Yield (function, arguments, path) of intrinsic functions in node
+    """
+    if isinstance(node, dict):
+        if len(node) == 1:
+            name, args = next(iter(node.items()))
+            if name in ('get_resource', 'get_attr', 'get_param'):
+                yield name, args, path
+        for key, value in node.items():
+            for item in _iter_functions(value, '%s.%s' % (path, key)):
+                yield item
+    elif isinstance(node, list):
+        for index, value in enumerate(node):
+            for item in _iter_functions(value, '%s[%d]' % (path, index)):
+                yield item
+
+
+def check_parameter_value(ptype, value):
+    """
+    Error message if value does not match the parameter type
+    """
+    if ptype == 'number':
+        if isinstance(value, bool):
+            return 'number expected, got %r' % value
+        try:
+            float(value)
+        except (TypeError, ValueError):
+            return 'number expected, got %r' % value
+    elif ptype == 'boolean':
+        if not (isinstance(value, bool) or
+                str(value).lower() in ('true', 'false', 'yes', 'no', 't',
+                                       'f', 'y', 'n', 'on', 'off', '1',
+                                       '0')):
+            return 'boolean expected, got %r' % value
+    elif ptype == 'comma_delimited_list':
+        if not isinstance(value, (list, str)):
+            return 'list expected, got %r' % value
+    elif ptype == 'json':
+        if isinstance(value, str):
+            try:
+                json.loads(value)
+            except ValueError:
+                return 'JSON expected, got %r' % value
+        elif not isinstance(value, (dict, list)):
+            return 'JSON expected, got %r' % value
+    elif ptype == 'string':
+        if isinstance(value, (dict, list)):
+            return 'string expected, got %r' % value
+    return None
+
+
+def _outputs_of(template):
+    return list((template.get('outputs') or {}).keys())
+
+
+def _check_template(template, name, parameters, files, nested_outputs,
+                    errors):
+    if not isinstance(template, dict):
+        errors.append('%s: template is not a map' % name)
+        return
+    if 'heat_template_version' not in template:
+        errors.append('%s: heat_template_version is missing' % name)
+
+    declared = template.get('parameters') or {}
+    for pname, definition in declared.items():
+        definition = definition or {}
+        ptype = definition.get('type')
+        if ptype not in PARAMETER_TYPES:
+            errors.append('%s: parameter %s has invalid type %r' %
+                          (name, pname, ptype))
+            continue
+        if 'default' in definition:
+            error = check_parameter_value(ptype, definition['default'])
+            if error:
+                errors.append('%s: default of parameter %s: %s' %
+                              (name, pname, error))
+        if parameters is None:
+            continue
+        if pname in parameters:
+            error = check_parameter_value(ptype, parameters[pname])
+            if error:
+                errors.append('%s: parameter %s: %s' % (name, pname, error))
+        elif 'default' not in definition:
+            errors.append('%s: parameter %s has no value' % (name, pname))
+    for pname in sorted(set(parameters or {}) - set(declared)):
+        errors.append('%s: parameter %s is not defined in template' %
+                      (name, pname))
+
+    resources = template.get('resources') or {}
+    if not isinstance(resources, dict):
+        errors.append('%s: resources is not a map' % name)
+        resources = {}
+    for rname, resource in resources.items():
+        if not isinstance(resource, dict) or not resource.get('type'):
+            errors.append('%s: resource %s has no type' % (name, rname))
+            continue
+        depends_on = resource.get('depends_on') or []
+        if isinstance(depends_on, str):
+            depends_on = [depends_on]
+        for dependency in depends_on:
+            if dependency not in resources:
+                errors.append('%s: resource %s depends on unknown resource '
+                              '%s' % (name, rname, dependency))
+
+        # properties of nested template resources are its parameters
+        rtype = resource['type']
+        if rtype == 'OS::Heat::ResourceGroup':
+            definition = (resource.get('properties') or {}).get(
+                'resource_def') or {}
+            rtype = definition.get('type')
+            properties = definition.get('properties') or {}
+        else:
+            properties = resource.get('properties') or {}
+        if rtype in files:
+            nested = files[rtype]
+            for pname in sorted(set(properties) -
+                                set(nested.get('parameters') or {})):
+                errors.append('%s: resource %s passes property %s not '
+                              'defined in %s' % (name, rname, pname, rtype))
+            for pname, definition in (nested.get('parameters') or
+                                      {}).items():
+                if ('default' not in (definition or {}) and
+                        pname not in properties):
+                    errors.append('%s: resource %s misses property %s of '
+                                  '%s' % (name, rname, pname, rtype))
+
+    _check_fixed_ips(resources, name, errors)
+
+    sections = [('resources.%s' % r, v) for r, v in resources.items()]
+    sections += [('outputs.%s' % o, v)
+                 for o, v in (template.get('outputs') or {}).items()]
+    for path, node in sections:
+        for function, args, fpath in _iter_functions(node, path):
+            where = '%s: %s' % (name, fpath)
+            if function == 'get_param':
+                pname = args[0] if isinstance(args, list) and args else args
+                if (isinstance(pname, str) and pname not in declared and
+                        pname not in PSEUDO_PARAMETERS):
+                    errors.append('%s: unknown parameter %s' % (where, pname))
+            elif function == 'get_resource':
+                if isinstance(args, str) and args not in resources:
+                    errors.append('%s: unknown resource %s' % (where, args))
+            elif function == 'get_attr':
+                if not isinstance(args, list) or len(args) < 2:
+                    errors.append('%s: get_attr needs resource and attribute'
+                                  % where)
+                    continue
+                rname, attr = args[0], args[1]
+                if not isinstance(rname, str):
+                    continue
+                if rname not in resources:
+                    errors.append('%s: unknown resource %s' % (where, rname))
+                    continue
+                if not isinstance(attr, str) or attr == 'show':
+                    continue
+                resource = resources[rname]
+                rtype = resource.get('type')
+                known = RESOURCE_ATTRIBUTES.get(rtype)
+                if rtype == 'OS::Heat::ResourceGroup':
+                    member = ((resource.get('properties') or {}).get(
+                        'resource_def') or {}).get('type')
+                    # attributes of members are aggregated by the group
+                    member_attrs = nested_outputs.get(
+                        member, RESOURCE_ATTRIBUTES.get(member))
+                    known = (None if member_attrs is None else
+                             tuple(known) + tuple(member_attrs))
+                elif rtype in nested_outputs:
+                    known = nested_outputs[rtype]
+                if (known is not None and attr not in known and
+                        not attr.startswith('resource.')):
+                    errors.append('%s: resource %s (%s) has no attribute %s'
+                                  % (where, rname, rtype, attr))
+
+    for oname, output in (template.get('outputs') or {}).items():
+        if not isinstance(output, dict) or 'value' not in output:
+            errors.append('%s: output %s has no value' % (name, oname))
+
+
+def _check_fixed_ips(resources, name, errors):
+    # pre-assigned addresses of ports must belong to their subnet
+    for rname, resource in resources.items():
+        if (not isinstance(resource, dict) or
+                resource.get('type') != 'OS::Neutron::Port'):
+            continue
+        for fixed_ip in (resource.get('properties') or {}).get(
+                'fixed_ips') or []:
+            if not isinstance(fixed_ip, dict):
+                continue
+            address = fixed_ip.get('ip_address')
+            subnet = fixed_ip.get('subnet_id') or fixed_ip.get('subnet')
+            if not isinstance(address, str) or not isinstance(subnet, dict):
+                continue
+            subnet = resources.get(subnet.get('get_resource'))
+            cidr = ((subnet or {}).get('properties') or {}).get('cidr')
+            if not isinstance(cidr, str):
+                continue
+            try:
+                if netaddr.IPAddress(address) not in netaddr.IPNetwork(cidr):
+                    errors.append('%s: address %s of port %s is not in '
+                                  'subnet %s' % (name, address, rname, cidr))
+            except (netaddr.AddrFormatError, ValueError):
+                errors.append('%s: port %s has invalid address %s' %
+                              (name, rname, address))
+
+
+def _parse(text, name, errors):
+    try:
+        return yaml.safe_load(text)
+    except yaml.YAMLError as e:
+        errors.append('%s: invalid YAML: %s' % (name, e))
+        return None
+
+
+def validate_template(template, parameters=None, files=None,
+                      required_outputs=None, name='template'):
+    """
+    Validate rendered template and its nested templates
+
+    :param parameters: values passed to the stack, checked against the
+        declared parameters when given
+    :param files: nested templates, by name
+    :param required_outputs: outputs the template must define
+    :raises TemplateError: with all problems found
+    """
+    errors = []
+    parsed = _parse(template, name, errors)
+
+    nested = {}
+    for file_name, text in (files or {}).items():
+        nested_template = _parse(text, file_name, errors)
+        if nested_template is not None:
+            nested[file_name] = nested_template
+            _check_template(nested_template, file_name, None, {}, {},
+                            errors)
+    nested_outputs = dict((file_name, _outputs_of(t))
+                          for file_name, t in nested.items()
+                          if isinstance(t, dict))
+
+    if parsed is not None:
+        _check_template(parsed, name, parameters, nested, nested_outputs,
+                        errors)
+        if isinstance(parsed, dict):
+            outputs = parsed.get('outputs') or {}
+            missing = [o for o in required_outputs or [] if o not in outputs]
+            if missing:
+                errors.append('%s: outputs %s are missing' %
+                              (name, ', '.join(missing)))
+
+    if errors:
+        raise TemplateError(errors)
+    LOG.debug('Template %s is valid', name)
@@ -0,0 +1,194 @@
+"""
+Lightweight leases of compute hosts shared by concurrent deployments.
+
+Every leased host is represented by a lease file in a directory shared by
+all runs (e.g. on NFS). Leases expire, so hosts of crashed runs become
+available again without manual cleanup; runs renew their leases while
+the hosts are in use. Lease files are only changed under an exclusive
+lock of the host.
+"""
+
+import contextlib
+import fcntl
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+from utilities import utils
+
+LOG = logging.getLogger(__name__)
+
+
+class HostLeases(object):
+    """
+    Leases of compute hosts held by one deployment
+    """
+    def __init__(self, lease_dir, owner, ttl=14400, scope=''):
+        self.lease_dir = lease_dir
+        self.owner = owner
+        self.ttl = ttl
+        self.scope = scope
+        self.hosts = set()
+        self._heartbeat = None
+        self._stopped = threading.Event()
+        os.makedirs(lease_dir, exist_ok=True)
+
+    def _path(self, host):
+        name = re.sub(r'[^\w.-]+', '_', '%s_%s' % (self.scope, host))
+        return os.path.join(self.lease_dir, name + '.lease')
+
+    def _read(self, host):
+        try:
+            with open(self._path(host)) as fd:
+                return json.load(fd)
+        except (FileNotFoundError, ValueError):
+            return None
+        except (IOError, OSError) as e:
+            # taking over a lease we can not read would steal the host
+            LOG.warning('Lease of host %s can not be read, treating it as '
+                        'held: %s', host, e)
+            return dict(owner=None, host=host, expires=float('inf'))
+
+    def _open_lock(self, host):
+        path = self._path(host) + '.lock'
+        try:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o664)
+        except FileExistsError:
+            pass
+        else:
+            # runs of other users sharing the group lock the same file
+            os.fchmod(fd, 0o664)
+            return fd
+        try:
+            return os.open(path, os.O_RDWR)
+        except PermissionError:
+            return os.open(path, os.O_RDONLY)
+
+    @contextlib.contextmanager
+    def _locked(self, host):
+        # the lock file is never removed, removing it would let two runs
+        # lock different files of the same host
+        fd = self._open_lock(host)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
+    def _is_foreign(self, lease):
+        return bool(lease and lease.get('owner') != self.owner and
+                    lease.get('expires', 0) > time.time())
+
+    def is_leased(self, host):
+        """
+        True if host is leased by another, live deployment
+        """
+        return self._is_foreign(self._read(host))
+
+    def _write(self, host):
+        utils.write_file_atomic(json.dumps(dict(
+            owner=self.owner, host=host, expires=time.time() + self.ttl)),
+            self._path(host))
+
+    def acquire(self, host):
+        """
+        Lease the host, returns False if it is leased by someone else
+
+        Stale and own leases are replaced.
+        """
+        with self._locked(host):
+            if self._is_foreign(self._read(host)):
+                return False
+            self._write(host)
+        self.hosts.add(host)
+        return True
+
+    def renew(self):
+        """
+        Extend own leases by ttl
+
+        :returns: hosts whose leases were lost (expired and taken over)
+        """
+        lost = []
+        for host in sorted(self.hosts):
+            with self._locked(host):
+                lease = self._read(host)
+                if lease and lease.get('owner') != self.owner:
+                    lost.append(host)
+                    continue
+                self._write(host)
+        if lost:
+            LOG.warning('Leases of hosts %s were taken over by another '
+                        'deployment', lost)
+            self.hosts.difference_update(lost)
+        return lost
+
+    def start_heartbeat(self, interval=None):
+        """
+        Renew the leases periodically (every third of ttl by default)
+        until all of them are released
+        """
+        if self._heartbeat and self._heartbeat.is_alive():
+            return
+        interval = interval or max(self.ttl / 3.0, 1)
+        self._stopped.clear()
+
+        def beat():
+            while not self._stopped.wait(interval):
+                try:
+                    self.renew()
+                except (IOError, OSError) as e:
+                    LOG.warning('Failed to renew leases of %s: %s',
+                                self.owner, e)
+
+        self._heartbeat = threading.Thread(target=beat, daemon=True,
+                                           name='lease-%s' % self.owner)
+        self._heartbeat.start()
+
+    def stop_heartbeat(self):
+        self._stopped.set()
+        if self._heartbeat:
+            self._heartbeat.join()
+            self._heartbeat = None
+
+    def acquire_all(self, hosts):
+        """
+        Lease all hosts or none of them
+
+        Hosts already held before the call stay leased on conflict.
+
+        :returns: hosts which are leased by someone else
+        """
+        acquired = []
+        conflicts = []
+        for host in sorted(set(hosts)):
+            held = host in self.hosts
+            if self.acquire(host):
+                if not held:
+                    acquired.append(host)
+            else:
+                conflicts.append(host)
+        if conflicts:
+            self.release(acquired)
+        else:
+            LOG.info('Hosts leased by %s: %s', self.owner, acquired)
+        return conflicts
+
+    def release(self, hosts=None):
+        """
+        Release own leases of hosts (all by default)
+        """
+        if hosts is None:
+            self.stop_heartbeat()
+        for host in list(self.hosts if hosts is None else hosts):
+            with self._locked(host):
+                lease = self._read(host)
+                if lease and lease.get('owner') == self.owner:
+                    try:
+                        os.unlink(self._path(host))
+                    except FileNotFoundError:
+                        pass
+            self.hosts.discard(host)
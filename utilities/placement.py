@@ -0,0 +1,76 @@
+"""
+History of compute hosts which already ran an image.
+
+Hosts keep downloaded Glance images in their cache, so deployments
+placed on them boot without the image transfer. Nova removes unused
+images from the cache after a while, hosts not used for longer than
+ttl are treated as cold again.
+"""
+
+import fcntl
+import json
+import logging
+import os
+import time
+
+from utilities import utils
+
+LOG = logging.getLogger(__name__)
+
+
+class PlacementHistory(object):
+    """
+    Hosts used per image, shared by all runs through a file
+    """
+    def __init__(self, history_file, ttl=86400, scope=''):
+        self.history_file = os.path.expanduser(history_file)
+        self.ttl = ttl
+        self.scope = scope
+
+    def _key(self, image_id):
+        return '%s|%s' % (self.scope, image_id)
+
+    def _load(self):
+        try:
+            with open(self.history_file) as fd:
+                return json.load(fd)
+        except (IOError, ValueError):
+            return {}
+
+    def warm_hosts(self, image_id):
+        """
+        Hosts which ran the image recently, most recently used first
+        """
+        hosts = self._load().get(self._key(image_id), {})
+        now = time.time()
+        return [host for host, used in
+                sorted(hosts.items(), key=lambda item: (-item[1], item[0]))
+                if now - used < self.ttl]
+
+    def record(self, image_id, hosts):
+        """
+        Remember that the hosts ran the image now
+        """
+        hosts = [host for host in hosts if host]
+        if not hosts:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.history_file) or '.',
+                        exist_ok=True)
+            # concurrent runs share the file, re-read it under the lock,
+            # so hosts recorded by others are kept
+            with open(self.history_file + '.lock', 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                history = self._load()
+                entry = history.setdefault(self._key(image_id), {})
+                now = time.time()
+                entry.update((host, now) for host in hosts)
+                for host in [h for h, used in entry.items()
+                             if now - used >= self.ttl]:
+                    del entry[host]
+                utils.write_file_atomic(json.dumps(history, indent=2,
+                                                   sort_keys=True),
+                                        self.history_file)
+        except (IOError, OSError) as e:
+            LOG.warning('Failed to store placement history %s: %s',
+                        self.history_file, e)
@@ -0,0 +1,154 @@
+"""
+Data-plane readiness probing of deployed TestVNFs.
+"""
+
+import asyncio
+import logging
+import queue
+import threading
+import time
+
+LOG = logging.getLogger(__name__)
+
+
+async def _run_command(command, host, timeout):
+    """
+    Run the check command against host, True if it succeeds in time
+    """
+    proc = await asyncio.create_subprocess_exec(
+        *[arg.format(host=host) for arg in command],
+        stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL)
+    try:
+        return await asyncio.wait_for(proc.wait(), timeout) == 0
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+        return False
+
+
+async def probe_agent(agent, port, timeout, deadline, interval,
+                      command=None):
+    """
+    Probe agent until its port accepts connections (and the command
+    succeeds), give up after timeout or at the global deadline
+
+    :returns: (agent id, True when the agent is ready)
+    """
+    host = agent['pip']
+    give_up = min(time.monotonic() + timeout, deadline)
+
+    while True:
+        left = give_up - time.monotonic()
+        if left <= 0:
+            break
+        try:
+            _reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(host, port), min(interval, left))
+            writer.close()
+            if (not command or
+                    await _run_command(command, host,
+                                       give_up - time.monotonic())):
+                LOG.debug('Agent %s (%s) is ready', agent['id'], host)
+                return agent['id'], True
+        except (OSError, asyncio.TimeoutError) as e:
+            LOG.debug('Agent %s (%s) is not ready yet: %s',
+                      agent['id'], host, e)
+        await asyncio.sleep(max(min(interval, give_up - time.monotonic()),
+                                0))
+
+    LOG.info('Agent %s (%s) did not become ready', agent['id'], host)
+    return agent['id'], False
+
+
+async def iter_ready_pairs(agents, port=22, timeout=300, deadline=600,
+                           interval=5, command=None):
+    """
+    Probe all agents concurrently, yield (master, slave) as soon as both
+    ends of a pair are ready
+
+    Agents deployed alone are yielded as pairs with themselves. Agents
+    without management address can not be probed and are treated as
+    ready.
+    """
+    deadline = time.monotonic() + deadline
+    ready = set(a['id'] for a in agents.values() if not a.get('pip'))
+    probes = [probe_agent(agent, port, timeout, deadline, interval, command)
+              for agent in agents.values() if agent.get('pip')]
+
+    def pair_of(agent_id):
+        agent = agents[agent_id]
+        if agent.get('mode') == 'master':
+            return agent, agents.get(agent.get('slave_id'))
+        if agent.get('mode') == 'slave':
+            return agents.get(agent.get('master_id')), agent
+        return agent, agent
+
+    # agents which need no probing may complete pairs right away
+    for agent_id in sorted(ready):
+        master, slave = pair_of(agent_id)
+        if (master and slave and master['id'] == agent_id and
+                slave['id'] in ready):
+            yield master, slave
+
+    for probe in asyncio.as_completed(probes):
+        agent_id, is_ready = await probe
+        if not is_ready:
+            continue
+        ready.add(agent_id)
+        master, slave = pair_of(agent_id)
+        if not master or not slave:
+            continue
+        other = slave['id'] if master['id'] == agent_id else master['id']
+        if other in ready:
+            yield master, slave
+
+
+def iter_ready(agents, port=22, timeout=300, deadline=600, interval=5,
+               command=None):
+    """
+    Yield (master, slave) as soon as both ends of a pair are ready
+
+    Probes run in an event loop of a thread of their own, so they go on
+    while the caller uses the pairs already yielded.
+    """
+    pairs = queue.Queue()
+    errors = []
+
+    def probe():
+        async def collect():
+            async for pair in iter_ready_pairs(
+                    agents, port, timeout, deadline, interval, command):
+                pairs.put(pair)
+        try:
+            asyncio.run(collect())
+        except Exception as e:
+            errors.append(e)
+        finally:
+            pairs.put(None)
+
+    thread = threading.Thread(target=probe, daemon=True, name='readiness')
+    thread.start()
+    count = 0
+    while True:
+        pair = pairs.get()
+        if pair is None:
+            break
+        count += len(set(agent['id'] for agent in pair))
+        yield pair
+    thread.join()
+    if errors:
+        raise errors[0]
+    LOG.info('%d of %d agents are ready', count, len(agents))
+
+
+def wait_ready(agents, port=22, timeout=300, deadline=600, interval=5,
+               command=None):
+    """
+    Filter agents, keeping only pairs with both ends ready
+    """
+    result = {}
+    for master, slave in iter_ready(agents, port, timeout, deadline,
+                                    interval, command):
+        result[master['id']] = master
+        result[slave['id']] = slave
+    return result
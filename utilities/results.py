@@ -0,0 +1,279 @@
+"""
+Append-only columnar store of traffic test results.
+
+Every column is a file of fixed size binary values, strings are stored
+as codes into a per-column dictionary. Rows are only appended, so the
+columns are read with a single read per column and queries are NumPy
+operations over whole columns.
+
+    <store>/<column>.col    float64 values or int32 string codes
+    <store>/<column>.dict   strings of the column, one JSON per line
+"""
+
+import array
+import fcntl
+import json
+import logging
+import os
+import sys
+
+from oslo_utils import importutils
+
+np = importutils.try_import('numpy')
+
+LOG = logging.getLogger(__name__)
+
+FLOAT_COLUMNS = (
+    'timestamp', 'packet_size', 'throughput_rx_fps', 'throughput_rx_mbps',
+    'throughput_rx_percent', 'tx_rate_fps', 'min_latency_ns',
+    'avg_latency_ns', 'max_latency_ns', 'frame_loss_percent',
+)
+STRING_COLUMNS = (
+    'run', 'scenario', 'template', 'sweep_point', 'pair', 'tgen', 'status',
+    'mode', 'master_node', 'master_zone', 'slave_node', 'slave_zone',
+)
+COLUMNS = FLOAT_COLUMNS + STRING_COLUMNS
+
+
+def _require_numpy():
+    if np is None:
+        raise RuntimeError('NumPy is required to query the results store')
+
+
+class Table(object):
+    """
+    Columns of the store, optionally restricted to selected rows
+    """
+    def __init__(self, columns, dictionaries):
+        self.columns = columns
+        self.dictionaries = dictionaries
+
+    def __len__(self):
+        return len(next(iter(self.columns.values()))) if self.columns else 0
+
+    def column(self, name):
+        """
+        Values of float column or codes of string column
+        """
+        return self.columns[name]
+
+    def strings(self, name):
+        """
+        Decoded values of string column
+        """
+        return np.array(self.dictionaries[name] + [''],
+                        dtype=object)[self.columns[name]]
+
+    def code(self, name, value):
+        """
+        Code of the string in column, -1 if it is not there
+        """
+        try:
+            return self.dictionaries[name].index(value)
+        except ValueError:
+            return -1
+
+    def where(self, mask=None, **filters):
+        """
+        Rows matching the mask and column filters, filter value may be
+        a list of accepted values
+        """
+        selected = np.ones(len(self), dtype=bool) if mask is None else mask
+        for name, value in filters.items():
+            values = value if isinstance(value, (list, tuple)) else [value]
+            if name in STRING_COLUMNS:
+                values = [self.code(name, v) for v in values]
+            selected = selected & np.isin(self.columns[name], values)
+        return Table(dict((name, column[selected])
+                          for name, column in self.columns.items()),
+                     self.dictionaries)
+
+
+class ResultStore(object):
+    """
+    Results of all runs, appended by any number of processes
+    """
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def _file(self, name, suffix):
+        return os.path.join(self.path, '%s.%s' % (name, suffix))
+
+    def _read_dictionary(self, name):
+        try:
+            with open(self._file(name, 'dict')) as fd:
+                return [json.loads(line) for line in fd if line.strip()]
+        except IOError:
+            return []
+
+    def append(self, rows):
+        """
+        Append rows (dicts), missing values are stored as NaN or ''
+        """
+        rows = list(rows)
+        if not rows:
+            return
+        with open(os.path.join(self.path, '.lock'), 'w') as lock:
+            # other writers may extend the dictionaries meanwhile
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self._repair()
+            for name in FLOAT_COLUMNS:
+                values = array.array('d', [_to_float(row.get(name))
+                                           for row in rows])
+                self._write(name, values)
+            for name in STRING_COLUMNS:
+                dictionary = self._read_dictionary(name)
+                index = dict((s, i) for i, s in enumerate(dictionary))
+                new = []
+                codes = array.array('i')
+                for row in rows:
+                    value = str(row.get(name) or '')
+                    if value not in index:
+                        index[value] = len(dictionary) + len(new)
+                        new.append(value)
+                    codes.append(index[value])
+                if new:
+                    with open(self._file(name, 'dict'), 'a') as fd:
+                        fd.writelines(json.dumps(s) + '\n' for s in new)
+                self._write(name, codes)
+        LOG.debug('%d rows are appended to results store %s',
+                  len(rows), self.path)
+
+    def _repair(self):
+        """
+        Drop the partial row of an interrupted writer, so new rows are
+        appended aligned in all columns
+        """
+        sizes = {}
+        for name in COLUMNS:
+            try:
+                sizes[name] = os.path.getsize(self._file(name, 'col'))
+            except OSError:
+                sizes[name] = 0
+        rows = min(sizes[name] // _itemsize(name) for name in COLUMNS)
+        for name in COLUMNS:
+            if sizes[name] != rows * _itemsize(name):
+                LOG.warning('Dropping partial row of column %s in results '
+                            'store %s', name, self.path)
+                with open(self._file(name, 'col'), 'ab') as fd:
+                    fd.truncate(rows * _itemsize(name))
+        for name in STRING_COLUMNS:
+            path = self._file(name, 'dict')
+            try:
+                with open(path, 'rb+') as fd:
+                    data = fd.read()
+                    if data and not data.endswith(b'\n'):
+                        fd.truncate(data.rfind(b'\n') + 1)
+            except IOError:
+                pass
+
+    def _write(self, name, values):
+        if sys.byteorder != 'little':
+            values.byteswap()
+        with open(self._file(name, 'col'), 'ab') as fd:
+            fd.write(values.tobytes())
+
+    def load(self):
+        """
+        Read all columns into a table
+        """
+        _require_numpy()
+        columns = {}
+        for name in COLUMNS:
+            dtype = '<f8' if name in FLOAT_COLUMNS else '<i4'
+            path = self._file(name, 'col')
+            columns[name] = (np.fromfile(path, dtype=dtype)
+                             if os.path.exists(path)
+                             else np.empty(0, dtype=dtype))
+        # a writer interrupted in the middle leaves a partial row behind
+        rows = min(len(column) for column in columns.values())
+        columns = dict((name, column[:rows])
+                       for name, column in columns.items())
+        dictionaries = dict((name, self._read_dictionary(name))
+                            for name in STRING_COLUMNS)
+        return Table(columns, dictionaries)
+
+
+def _itemsize(name):
+    return 8 if name in FLOAT_COLUMNS else 4
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return float('nan')
+
+
+def breakdown(table, by, metric, percentiles=(50, 90, 99)):
+    """
+    Count, mean and percentiles of metric per value of column(s) by
+
+    :returns: {key: {'count': n, 'mean': x, 'p50': y, ...}}, key is a
+        value or a tuple of values when grouped by several columns
+    """
+    _require_numpy()
+    by = [by] if isinstance(by, str) else list(by)
+    values = table.column(metric)
+    valid = ~np.isnan(values)
+    values = values[valid]
+    if not len(values):
+        return {}
+
+    keys = np.stack([table.column(name)[valid].astype('f8')
+                     for name in by], axis=1)
+    unique, groups = np.unique(keys, axis=0, return_inverse=True)
+    groups = groups.reshape(-1)
+    order = np.lexsort((values, groups))
+    values = values[order]
+    counts = np.bincount(groups, minlength=len(unique))
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    means = np.add.reduceat(values, starts) / counts
+
+    # linear interpolation between closest ranks, all groups at once
+    q = np.asarray(percentiles, dtype='f8') / 100.0
+    position = starts[:, None] + (counts[:, None] - 1) * q[None, :]
+    low = np.floor(position).astype(int)
+    high = np.ceil(position).astype(int)
+    fraction = position - low
+    result_values = values[low] + (values[high] - values[low]) * fraction
+
+    decoded = []
+    for i, name in enumerate(by):
+        if name in STRING_COLUMNS:
+            names = table.dictionaries[name]
+            decoded.append([names[int(code)] for code in unique[:, i]])
+        else:
+            decoded.append([float(value) for value in unique[:, i]])
+
+    result = {}
+    for g in range(len(unique)):
+        key = tuple(column[g] for column in decoded)
+        stats = dict(count=int(counts[g]), mean=float(means[g]))
+        for p, value in zip(percentiles, result_values[g]):
+            stats['p%g' % p] = float(value)
+        result[key if len(by) > 1 else key[0]] = stats
+    return result
+
+
+def find_regressions(table, baseline, run, metric, by=('tgen', 'packet_size'),
+                     threshold=0.05, higher_is_better=True,
+                     statistic='p50'):
+    """
+    Groups of the run whose metric is worse than in the baseline run by
+    more than threshold (relative)
+    """
+    base = breakdown(table.where(run=baseline), by, metric)
+    current = breakdown(table.where(run=run), by, metric)
+    regressions = []
+    for key in sorted(set(base) & set(current), key=str):
+        before = base[key][statistic]
+        after = current[key][statistic]
+        if not before:
+            continue
+        change = (after - before) / abs(before)
+        if (change < -threshold) if higher_is_better else (change > threshold):
+            regressions.append(dict(key=key, metric=metric, baseline=before,
+                                    value=after, change=change))
+    return regressions
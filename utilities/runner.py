@@ -0,0 +1,227 @@
+"""
+Parallel execution of VSPERF runs for deployed TestVNF pairs.
+
+Every run is a VSPERF process driven by a worker thread. Runs which use
+the same traffic generator port are never executed at the same time,
+results are yielded as runs finish.
+"""
+
+import concurrent.futures
+import contextvars
+import csv
+import glob
+import json
+import logging
+import os
+import signal
+import subprocess
+import threading
+import time
+
+LOG = logging.getLogger(__name__)
+
+# returned by the runs source when it is exhausted
+_END = object()
+
+
+def iter_manifest_runs(manifest_path, tgens=None):
+    """
+    Runs described by manifest of generated configuration files
+    """
+    with open(manifest_path) as fd:
+        manifest = json.load(fd)
+    return iter_entry_runs(manifest['pairs'], tgens)
+
+
+def iter_entry_runs(entries, tgens=None):
+    """
+    Runs of manifest entries, entries are consumed lazily
+    """
+    for entry in entries:
+        for tgen, conf in sorted(entry['confs'].items()):
+            if tgens and tgen not in tgens:
+                continue
+            yield dict(pair=entry['pair'], master=entry['master'],
+                       slave=entry['slave'], tgen=tgen, conf=conf,
+                       results=entry.get('results', {}).get(
+                           tgen, os.path.dirname(conf)),
+                       ports=entry.get('ports', {}).get(tgen, []))
+
+
+def read_results(results_dir):
+    """
+    Rows of all result CSV files VSPERF wrote into the directory
+    """
+    rows = []
+    pattern = os.path.join(results_dir, '**', 'result_*.csv')
+    for path in sorted(glob.glob(pattern, recursive=True)):
+        with open(path, newline='') as fd:
+            for row in csv.DictReader(fd):
+                row['file'] = os.path.relpath(path, results_dir)
+                rows.append(row)
+    return rows
+
+
+def _kill(proc):
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+class ProcessGroup(object):
+    """
+    VSPERF processes running in worker threads, killed all at once
+
+    Runs are started in sessions of their own, so they do not get
+    SIGINT of the terminal and have to be killed explicitly.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._processes = set()
+        self.closed = False
+
+    def add(self, proc):
+        with self._lock:
+            if not self.closed:
+                self._processes.add(proc)
+                return
+        # started after the group was killed
+        _kill(proc)
+
+    def discard(self, proc):
+        with self._lock:
+            self._processes.discard(proc)
+
+    def kill_all(self):
+        with self._lock:
+            self.closed = True
+            processes = list(self._processes)
+        for proc in processes:
+            LOG.warning('Killing VSPERF process %d', proc.pid)
+            _kill(proc)
+
+
+def execute_run(run, command, timeout, processes=None):
+    """
+    Execute one VSPERF run, wait for it at most timeout seconds
+
+    :param processes: ProcessGroup the process is registered in while
+        it runs
+    :returns: run with status, return code, duration and result rows
+    """
+    os.makedirs(run['results'], exist_ok=True)
+    args = [arg.format(**run) for arg in command]
+    log_path = os.path.join(run['results'], 'vsperf.log')
+    result = dict(run, command=args, log=log_path)
+
+    start = time.time()
+    result['returncode'] = None
+    with open(log_path, 'wb') as log:
+        try:
+            # own process group, so helpers spawned by VSPERF are killed
+            # together with it on timeout
+            proc = subprocess.Popen(args, stdout=log,
+                                    stderr=subprocess.STDOUT,
+                                    stdin=subprocess.DEVNULL,
+                                    start_new_session=True)
+        except OSError as e:
+            result['status'] = 'failed'
+            result['error'] = str(e)
+        else:
+            if processes is not None:
+                processes.add(proc)
+            try:
+                result['returncode'] = proc.wait(timeout)
+                result['status'] = ('ok' if result['returncode'] == 0
+                                    else 'failed')
+            except subprocess.TimeoutExpired:
+                _kill(proc)
+                proc.wait()
+                result['status'] = 'timeout'
+            finally:
+                if processes is not None:
+                    processes.discard(proc)
+    result['duration'] = time.time() - start
+    result['rows'] = read_results(run['results'])
+    return result
+
+
+def iter_results(runs, command, max_workers=8, timeout=3600):
+    """
+    Execute runs in parallel, yield results as runs finish
+
+    At most max_workers runs are executed at once, runs sharing a
+    traffic generator port wait until the port is released. Runs may be
+    a generator (e.g. of pairs still being deployed), it is read in a
+    thread of its own, so runs finishing meanwhile are yielded without
+    waiting for it. The next run is taken only when a worker is free and
+    no pending run waits for a port.
+
+    Running VSPERF processes are killed when the iteration is left
+    early (interrupt, failure of the runs source, generator closed).
+    """
+    source = iter(runs)
+    exhausted = False
+    pending = []
+    busy = set()
+    futures = {}
+    processes = ProcessGroup()
+    # the source is read in the settings context of the caller
+    context = contextvars.copy_context()
+    reader = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    reading = None
+
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers) as executor:
+        try:
+            while True:
+                while len(futures) < max_workers:
+                    run = next((r for r in pending
+                                if not busy.intersection(r['ports'])), None)
+                    if run is None:
+                        if not (exhausted or pending or reading):
+                            reading = reader.submit(context.run, next,
+                                                    source, _END)
+                        break
+                    pending.remove(run)
+                    busy.update(run['ports'])
+                    LOG.info('Starting VSPERF run of pair %s with %s',
+                             run['pair'], run['tgen'])
+                    futures[executor.submit(execute_run, run, command,
+                                            timeout, processes)] = run
+                if not futures and not reading:
+                    break
+
+                done, _not_done = concurrent.futures.wait(
+                    list(futures) + ([reading] if reading else []),
+                    return_when=concurrent.futures.FIRST_COMPLETED)
+                if reading in done:
+                    run = reading.result()
+                    reading = None
+                    if run is _END:
+                        exhausted = True
+                    else:
+                        pending.append(run)
+                for future in done:
+                    if future not in futures:
+                        continue
+                    run = futures.pop(future)
+                    busy.difference_update(run['ports'])
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        LOG.exception(e)
+                        result = dict(run, status='failed', error=str(e),
+                                      rows=[])
+                    LOG.info('VSPERF run of pair %(pair)s with %(tgen)s: '
+                             '%(status)s', result)
+                    yield result
+        finally:
+            # the executor waits for its workers on exit, so the runs
+            # still in progress are stopped first
+            if futures:
+                for future in futures:
+                    future.cancel()
+                processes.kill_all()
+            reader.shutdown(wait=False)
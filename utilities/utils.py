@@ -2,15 +2,24 @@ from conf import settings as S
 
 import errno
 import functools
+import logging
 import os
 import random
 import re
+import string
+import tempfile
 import uuid
 import collections
 from pykwalify import core as pykwalify_core
 from pykwalify import errors as pykwalify_errors
 import yaml
 
+LOG = logging.getLogger(__name__)
+
+# umask can be read only by setting it, done once before threads start
+_UMASK = os.umask(0o022)
+os.umask(_UMASK)
+
 
 def read_file(file_name, base_dir='', alias_mapper=None):
     """
@@ -63,6 +72,28 @@ def write_file(data, file_name, base_dir=''):
             fd.close()
 
 
+def write_file_atomic(data, file_name, base_dir='', mode=None):
+    """
+    Write to file atomically - readers never see partially written file
+
+    The file gets ``mode``, by default the mode of files created by
+    ``open`` (0666 without umask) rather than 0600 of temporary files.
+    """
+    full_path = os.path.normpath(os.path.join(base_dir, file_name))
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(full_path),
+                                    prefix='.tmp_')
+    try:
+        with os.fdopen(fd, 'w') as tmp_file:
+            os.fchmod(tmp_file.fileno(),
+                      0o666 & ~_UMASK if mode is None else mode)
+            tmp_file.write(data)
+        os.replace(tmp_path, full_path)
+    except BaseException as e:
+        LOG.error('Error writing file: %s', e)
+        os.unlink(tmp_path)
+        raise
+
+
 def read_yaml_file(file_name):
     """
     Read Yaml File
@@ -95,11 +126,13 @@ def split_address(address):
     return host, port
 
 
-def random_string(length=6):
+def random_string(length=8):
     """
     Generate Random String
     """
-    return ''.join(random.sample('adefikmoprstuz', length))
+    rand = random.SystemRandom()
+    return ''.join(rand.choice(string.ascii_lowercase + string.digits)
+                   for _ in range(length))
 
 
 def make_record_id():
@@ -0,0 +1,240 @@
+"""
+Generation of VSPERF configuration files for deployed TestVNF pairs.
+"""
+
+import ast
+import functools
+import json
+import logging
+import os
+import re
+
+from utilities import utils
+
+LOG = logging.getLogger(__name__)
+
+# base configuration file of every supported traffic generator
+TGEN_BASE_FILES = {
+    'trex': 'vsperf-trex.conf',
+    'spirent': 'vsperf-spirent.conf',
+    'ixnet': 'vsperf-ixnet.conf',
+}
+
+# options identifying every traffic generator port used by a run, runs
+# sharing a port can not be executed at the same time
+TGEN_PORT_OPTIONS = {
+    'trex': [
+        ('TRAFFICGEN_TREX_HOST_IP_ADDR', 'TRAFFICGEN_TREX_PORT1'),
+        ('TRAFFICGEN_TREX_HOST_IP_ADDR', 'TRAFFICGEN_TREX_PORT2'),
+    ],
+    'spirent': [
+        ('TRAFFICGEN_STC_EAST_CHASSIS_ADDR', 'TRAFFICGEN_STC_EAST_SLOT_NUM',
+         'TRAFFICGEN_STC_EAST_PORT_NUM'),
+        ('TRAFFICGEN_STC_WEST_CHASSIS_ADDR', 'TRAFFICGEN_STC_WEST_SLOT_NUM',
+         'TRAFFICGEN_STC_WEST_PORT_NUM'),
+    ],
+    'ixnet': [
+        ('TRAFFICGEN_EAST_IXIA_HOST', 'TRAFFICGEN_EAST_IXIA_CARD',
+         'TRAFFICGEN_EAST_IXIA_PORT'),
+        ('TRAFFICGEN_WEST_IXIA_HOST', 'TRAFFICGEN_WEST_IXIA_CARD',
+         'TRAFFICGEN_WEST_IXIA_PORT'),
+    ],
+}
+
+_ASSIGNMENT = re.compile(r'^([A-Z][A-Z0-9_]*)\s*=\s*(.*)$')
+
+
+class BaseConf(object):
+    """
+    Parsed base configuration of a traffic generator
+    """
+    def __init__(self, text):
+        self.lines = text.splitlines()
+        # position of the (last) top level assignment of every option
+        self.index = {}
+        for number, line in enumerate(self.lines):
+            match = _ASSIGNMENT.match(line)
+            if match:
+                self.index[match.group(1)] = number
+
+    def value(self, key):
+        """
+        Value of the option in the base configuration
+        """
+        if key not in self.index:
+            return None
+        raw = _ASSIGNMENT.match(self.lines[self.index[key]]).group(2)
+        raw = raw.split('#', 1)[0].strip()
+        try:
+            return ast.literal_eval(raw)
+        except (ValueError, SyntaxError):
+            return raw
+
+    def render(self, values):
+        """
+        Render the configuration with ``values`` replacing the base ones
+        """
+        lines = list(self.lines)
+        extra = []
+        for key, value in values.items():
+            line = '%s = %r' % (key, value)
+            if key in self.index:
+                lines[self.index[key]] = line
+            else:
+                extra.append(line)
+        return '\n'.join(lines + extra) + '\n'
+
+
+@functools.lru_cache(maxsize=None)
+def load_base_conf(tgen, conf_dir):
+    """
+    Read and parse base configuration of traffic generator - only once
+    """
+    if tgen not in TGEN_BASE_FILES:
+        raise ValueError('Unsupported traffic generator: %s' % tgen)
+    with open(os.path.join(conf_dir, TGEN_BASE_FILES[tgen])) as fd:
+        return BaseConf(fd.read())
+
+
+def iter_pairs(agents):
+    """
+    Iterate over (master, slave) pairs of the agents map
+
+    Agents deployed alone are returned as pairs with themselves.
+    """
+    for agent_id in sorted(agents):
+        agent = agents[agent_id]
+        if agent.get('mode') == 'master':
+            slave = agents.get(agent.get('slave_id'))
+            if slave:
+                yield agent, slave
+        elif agent.get('mode') == 'alone':
+            yield agent, agent
+
+
+def pair_settings(tgen, master, slave):
+    """
+    VSPERF options pointing traffic generator at the pair
+    """
+    if tgen == 'trex':
+        return {
+            'TRAFFICGEN_TREX_HOST_IP_ADDR': master.get('pip'),
+        }
+    if tgen == 'spirent':
+        return {
+            'TRAFFICGEN_STC_EAST_CHASSIS_ADDR': master.get('pip'),
+            'TRAFFICGEN_STC_WEST_CHASSIS_ADDR': slave.get('pip'),
+            'TRAFFICGEN_STC_EAST_INTF_ADDR': master.get('ip'),
+            'TRAFFICGEN_STC_EAST_INTF_GATEWAY_ADDR': slave.get('ip'),
+            'TRAFFICGEN_STC_WEST_INTF_ADDR': slave.get('ip'),
+            'TRAFFICGEN_STC_WEST_INTF_GATEWAY_ADDR': master.get('ip'),
+        }
+    if tgen == 'ixnet':
+        return {
+            'TRAFFICGEN_EAST_IXIA_HOST': master.get('pip'),
+            'TRAFFICGEN_WEST_IXIA_HOST': slave.get('pip'),
+        }
+    raise ValueError('Unsupported traffic generator: %s' % tgen)
+
+
+def data_path_settings(master, slave):
+    """
+    VSPERF options of pairs attached through SR-IOV or PCI passthrough
+
+    Device under test NICs are the PCI devices backing data ports of
+    the pair.
+    """
+    pcis = [agent.get('pci') or {} for agent in (master, slave)]
+    slots = [pci.get('pci_slot') for pci in pcis]
+    if not all(slots):
+        return {}
+    if master is slave:
+        slots = slots[:1]
+    return {'WHITELIST_NICS': slots}
+
+
+def data_path(master, slave):
+    """
+    Data path details of the pair stored in the manifest
+    """
+    return dict((role, agent['pci']) for role, agent in
+                (('master', master), ('slave', slave)) if agent.get('pci'))
+
+
+def port_keys(tgen, base, values):
+    """
+    Keys of traffic generator ports used with the configuration
+    """
+    keys = []
+    for options in TGEN_PORT_OPTIONS.get(tgen, []):
+        keys.append('|'.join([tgen] + [
+            str(values[o] if o in values else base.value(o))
+            for o in options]))
+    return keys
+
+
+def iter_pair_confs(pairs, tgens, conf_dir, dest_dir, values=None):
+    """
+    Write configuration files for every pair, yield manifest entries
+
+    Pairs are consumed lazily, so the files of the first pair are ready
+    before the following pairs are even known. Common values are written
+    into configuration of every pair. Every configuration stores results
+    into a directory of its own.
+    """
+    bases = dict((tgen, load_base_conf(tgen, conf_dir)) for tgen in tgens)
+    os.makedirs(dest_dir, exist_ok=True)
+
+    for master, slave in pairs:
+        entry = dict(pair=master['id'], master=master['id'],
+                     slave=slave['id'], confs={}, results={}, ports={})
+        pci = data_path(master, slave)
+        if pci:
+            entry['data_path'] = pci
+        for tgen, base in bases.items():
+            name = 'vsperf-%s-%s' % (tgen, master['id'])
+            path = os.path.join(dest_dir, name + '.conf')
+            conf_values = dict(values or {})
+            conf_values.update(data_path_settings(master, slave))
+            conf_values.update(pair_settings(tgen, master, slave))
+            conf_values['RESULTS_PATH'] = os.path.abspath(
+                os.path.join(dest_dir, 'results', name))
+            utils.write_file_atomic(base.render(conf_values), path)
+            entry['confs'][tgen] = path
+            entry['results'][tgen] = conf_values['RESULTS_PATH']
+            entry['ports'][tgen] = port_keys(tgen, base, conf_values)
+        LOG.debug('VSPERF configuration for pair %s: %s',
+                  entry['pair'], entry['confs'])
+        yield entry
+
+
+def write_pair_confs(pairs, tgens, conf_dir, dest_dir,
+                     manifest_name='manifest.json', values=None, tags=None):
+    """
+    Write configuration files of all pairs together with their manifest
+
+    Tags (e.g. sweep point) are stored in the manifest as they are.
+
+    :returns: Path to the manifest file.
+    """
+    entries = list(iter_pair_confs(pairs, tgens, conf_dir, dest_dir,
+                                   values))
+    return write_manifest(entries, tgens, dest_dir, manifest_name, tags)
+
+
+def write_manifest(entries, tgens, dest_dir, manifest_name='manifest.json',
+                   tags=None):
+    """
+    Write manifest of configuration files written by iter_pair_confs
+
+    :returns: Path to the manifest file.
+    """
+    manifest_path = os.path.join(dest_dir, manifest_name)
+    manifest = dict(trafficgens=list(tgens), pairs=entries)
+    if tags:
+        manifest['tags'] = tags
+    utils.write_file_atomic(
+        json.dumps(manifest, indent=2, sort_keys=True), manifest_path)
+    LOG.info('VSPERF configuration of %d pairs is written to %s',
+             len(entries), dest_dir)
+    return manifest_path